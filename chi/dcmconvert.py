@@ -1,9 +1,12 @@
-from chi.util import DFBatchParRun, EntryPoints
+from chi.util import DFBatchParRun, EntryPoints, read_table
+import functools
+import hashlib
+import json
 import pandas
 import shutil
 import pydicom
 
-from chi import dicom, dcmscanner
+from chi import dicom, dcmscanner, mmapio, pack, pgzip, seriesindex
 
 entry = EntryPoints()
 def main():
@@ -20,17 +23,34 @@ def read_tag(s):
 
 # TODO Add support for multiple sub series tag specification (ie take files from Ac num X AND orientation Y)
 class ConvertBatchParRun(DFBatchParRun):
-    def __init__(self, convert_func, input_root, output_root, output_tag):
+    """Run convert_func for each row of a conversion table.
+
+    The iter_args are the conversion table's iter_info, the dicom index and
+    optionally a manifest (a dict of output name to fingerprint, see
+    load_manifest). With a manifest, each row gets a Fingerprint of its input
+    files and params, and rows whose output exists with the same fingerprint
+    are Skipped. Fingerprints are computed while iterating, in the parent
+    process, so the manifest isn't sent to the workers with every task.
+    """
+    def __init__(self, convert_func, input_root, output_root, output_tag, params=None):
         self.convert_func = convert_func
         self.input_root = input_root
         self.output_root = output_root
         self.output_tag = output_tag
+        self.params = params
 
-    def iteration_count(self, iter_info, dcm):
+    def iteration_count(self, iter_info, dcm, manifest=None):
         return super().iteration_count(iter_info)
 
-    def iterate(self, start, stop, iter_info, dcm):
-        for ix, row in super().iterate(start, stop, iter_info):
+    def iterate(self, start, stop, iter_info, dcm, manifest=None):
+        # Source stats for this run's fingerprints
+        stats = {}
+        rows = super().iterate(start, stop, iter_info)
+        if isinstance(dcm, seriesindex.PartitionedIndex):
+            # Only load the series this batch converts
+            rows = list(rows)
+            dcm = dcm.read([row['SeriesInstanceUID'] for _, row in rows], index_col=0)
+        for ix, row in rows:
             series = row['SeriesInstanceUID']
             SERIES = dicom.Tag.from_pydicom_attr("SeriesInstanceUID").keyword()
             full = row['FullSeries']
@@ -51,13 +71,104 @@ class ConvertBatchParRun(DFBatchParRun):
             if not full:
                 dcm_rows &= (dcm[SUBSERIES].map(lambda s: str(s).strip()==str(subseries).strip()))
             
-            yield ix, row, dcm.loc[dcm_rows]
+            dcm_loc = dcm.loc[dcm_rows]
+            if manifest is not None:
+                fingerprint = conversion_fingerprint(row, dcm_loc, self.input_root, self.params, stats)
+                output = row[self.output_tag]
+                skip = manifest.get(output) == fingerprint and os.path.exists(os.path.join(self.output_root, output))
+                row = row.copy()
+                row['Fingerprint'] = fingerprint
+                row['Skipped'] = skip
+                if skip:
+                    dcm_loc = None
+
+            yield ix, row, dcm_loc
 
     def execute_one(self, arg):
         ix, row, dcm_loc = arg
+        if dcm_loc is None:
+            result = row.copy()
+            result['error'] = ""
+            return self.single(result)
         result = self.convert_func(self.input_root, self.output_root, self.output_tag, ix, row, dcm_loc)
         return self.single(result)
 
+def _source_stat(path, stats=None):
+    if stats is not None and path in stats:
+        return stats[path]
+    st = os.stat(path)
+    result = (st.st_size, st.st_mtime_ns)
+    if stats is not None:
+        stats[path] = result
+    return result
+
+def conversion_fingerprint(row, dcm, input_root, params=None, stats=None):
+    """A hash of a conversion row, its selected dicom rows, their source files and params.
+
+    Sources (zips, packs or raw files) are identified by path, size and
+    modification time, so replacing an archive changes the fingerprint. stats,
+    if given, is a dict caching the source stats, and should only live for one run.
+    """
+    if pack.is_pack_index(dcm):
+        sources = dcm['Pack'].unique()
+    elif 'ZipFile' in dcm.columns:
+        sources = dcm['ZipFile'].unique()
+    else:
+        sources = dcm.index.unique()
+
+    h = hashlib.sha256()
+    h.update(json.dumps({"row": row.astype(str).to_dict(), "params": params}, sort_keys=True, default=str).encode())
+    files = dcm.reset_index().astype(str)
+    h.update(files.sort_values(list(files.columns)).to_csv(index=False).encode())
+    for source in sorted(str(src) for src in sources):
+        h.update(json.dumps([source, _source_stat(os.path.join(input_root, source), stats)]).encode())
+    return h.hexdigest()
+
+def manifest_shards(path):
+    """The shard files of the manifest at path, oldest first."""
+    shard_dir = f"{path}.d"
+    if not os.path.isdir(shard_dir):
+        return []
+    shards = [os.path.join(shard_dir, f) for f in os.listdir(shard_dir) if f.endswith(".csv")]
+    return sorted(shards, key=lambda f: os.stat(f).st_mtime_ns)
+
+def load_manifest(path):
+    """{output: fingerprint} from the manifest at path, empty if there is none.
+
+    The manifest is the CSV at path (if any) and the shards written next to it
+    by update_manifest, merged with the newest shards taking precedence.
+    """
+    manifest = {}
+    for f in ([path] if os.path.exists(path) else []) + manifest_shards(path):
+        manifest.update(pandas.read_csv(f, index_col=0, dtype=str)['Fingerprint'].to_dict())
+    return manifest
+
+def update_manifest(path, results, output_tag, shard):
+    """Record the fingerprints of successful conversions in the manifest at path.
+
+    They are written to the shard named shard (one per task, eg its batch), in
+    the path.d directory, and replaced atomically, so concurrent tasks never
+    drop each other's entries.
+    """
+    ok = results.loc[results['error'].fillna("") == ""]
+    table = pandas.Series(ok['Fingerprint'].values, index=ok[output_tag].values, name='Fingerprint').rename_axis('Output').to_frame()
+    shard_dir = f"{path}.d"
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_path = os.path.join(shard_dir, f"{shard}.csv")
+    tmp = f"{shard_path}.{os.getpid()}.tmp"
+    table.to_csv(tmp)
+    os.replace(tmp, shard_path)
+
+
+def load_dicom_index(path):
+    """The scan table at path, or a PartitionedIndex if it was written by partition_index."""
+    if seriesindex.is_partitioned(path):
+        index = seriesindex.PartitionedIndex(path)
+        if index.key != "SeriesInstanceUID":
+            # Conversion rows select series by SeriesInstanceUID
+            raise ValueError(f"{path} is partitioned by {index.key}, not SeriesInstanceUID")
+        return index
+    return read_table(path, index_col=0)
 
 import tempfile
 def get_tempdir():
@@ -69,13 +180,19 @@ def get_tempdir():
 
 @entry.point
 def convert(args):
-    runner = ConvertBatchParRun(convert_impl, args.dicom_root, args.output_root, args.output_column)
-    dcm = pandas.read_csv(args.dicom_index, index_col=0)
+    convert_func = functools.partial(convert_impl, gzip_threads=args.gzip_threads, gzip_level=args.gzip_level, decode_threads=args.decode_threads, use_mmap=args.mmap, stream_slab=args.stream_slab)
+    manifest = load_manifest(args.manifest) if args.manifest is not None else None
+    params = dict(gzip_level=args.gzip_level)
+    runner = ConvertBatchParRun(convert_func, args.dicom_root, args.output_root, args.output_column, params=params)
+    dcm = load_dicom_index(args.dicom_index)
     convs = pandas.read_csv(args.conversions)
     iter_info = runner.iter_info(convs)
-    results = runner.run_from_args(args, iter_args=(iter_info, dcm))
+    results = runner.run_from_args(args, iter_args=(iter_info, dcm, manifest))
     if args.output_file is not None:
         results.to_csv(args.output_file, index=False)
+    if args.manifest is not None:
+        print(f"Skipped {int(results['Skipped'].sum())} of {results.shape[0]} conversions")
+        update_manifest(args.manifest, results, args.output_column, shard=f"batch_{args.batch_start}_{args.batch_count}")
 
 import contextlib
 import sys
@@ -95,7 +212,24 @@ def redirect_stderr_fdesc(to_file_no):
         os.dup2(original_stderr_fdesc, sys.stderr.fileno())
         os.close(original_stderr_fdesc)
 
-def convert_impl(input_root, output_root, target_tag, ix, row, dcm):
+def write_image(img, output_file, tmp_folder, gzip_threads=0, gzip_level=6):
+    """Write img, compressing .gz outputs with pgzip when gzip_threads != 0.
+
+    The image is first written uncompressed into tmp_folder, then compressed
+    in parallel to output_file. gzip_threads=-1 uses all cores.
+    """
+    if gzip_threads == 0 or not output_file.endswith(".gz"):
+        sitk.WriteImage(img, output_file)
+        return
+
+    raw_file = os.path.join(tmp_folder, os.path.basename(output_file)[:-len(".gz")])
+    sitk.WriteImage(img, raw_file, useCompression=False)
+    try:
+        pgzip.compress_file(raw_file, output_file, level=gzip_level, threads=gzip_threads)
+    finally:
+        os.unlink(raw_file)
+
+def convert_impl(input_root, output_root, target_tag, ix, row, dcm, gzip_threads=0, gzip_level=6, decode_threads=0, use_mmap=False, stream_slab=0):
     out_filename = row[target_tag]
     name, ext = os.path.splitext(out_filename)
     if ext == ".gz":
@@ -106,7 +240,7 @@ def convert_impl(input_root, output_root, target_tag, ix, row, dcm):
     tmp_root = get_tempdir()
     tmp_folder = os.path.join(tmp_root, name)
     os.makedirs(tmp_folder, exist_ok=True)
-    out_files = extract_selected_dicoms(dcm, input_root, tmp_folder)
+    out_files = extract_selected_dicoms(dcm, input_root, tmp_folder, use_mmap)
 
     output_file = os.path.join(output_root, out_filename)
     output_dir = os.path.dirname(output_file)
@@ -122,8 +256,11 @@ def convert_impl(input_root, output_root, target_tag, ix, row, dcm):
             with redirect_stderr_fdesc(tmpf.fileno()):
                 loader = dicom.SeriesLoadResult.from_files(out_files)
                 assert not loader.has_subseries()
-                img = loader.load_series()
-                sitk.WriteImage(img, output_file)
+                if stream_slab > 0:
+                    loader.stream_series(output_file, slab_size=stream_slab, threads=decode_threads if decode_threads != 0 else 1, gzip_threads=gzip_threads, gzip_level=gzip_level)
+                else:
+                    img = loader.load_series(threads=decode_threads)
+                    write_image(img, output_file, tmp_folder, gzip_threads, gzip_level)
         except Exception as e:
             print(row)
             print(e)
@@ -146,8 +283,7 @@ def convert_impl(input_root, output_root, target_tag, ix, row, dcm):
     return orow
 
 
-@convert.parser
-def convert_parser(parser):
+def conversion_table_parser(parser):
     ConvertBatchParRun.update_parser(parser)
     # Anything else
     parser.add_argument("--dicom_root", required=True)
@@ -157,73 +293,128 @@ def convert_parser(parser):
     parser.add_argument("--output_root", required=True)
     parser.add_argument("--output_column", required=True) # Column specifying output name in conversions
     parser.add_argument("--output_file", required=False)
+    parser.add_argument("--mmap", action='store_true')
+
+@convert.parser
+def convert_parser(parser):
+    conversion_table_parser(parser)
+    parser.add_argument("--gzip_threads", required=False, type=int, default=0)
+    parser.add_argument("--gzip_level", required=False, type=int, default=6)
+    parser.add_argument("--decode_threads", required=False, type=int, default=0)
+    parser.add_argument("--manifest", required=False, help="Fingerprint manifest: rows whose output is unchanged since it was recorded are skipped. Each task records its conversions in a shard in MANIFEST.d.")
+    parser.add_argument("--stream_slab", required=False, type=int, default=0)
 
 import shutil
 import os
 import zipfile
 import SimpleITK as sitk
 
-def extract_selected_dicoms(dcm, input_root, output_folder):
-    files = list(dcm.index)
-    if ('ZipFile' in dcm.columns) and ('ArcName' in dcm.columns):
-        zip_mode = True
-    else:
-        zip_mode = False
-
-
-    # Delete the output files if they exist
-    # TODO Support for zip archives.
-    if os.listdir(output_folder):
-        for n in os.listdir(output_folder):
-            os.unlink(os.path.join(output_folder, n))
-    # TODO this really ought to be grouped by zipfile and the file opened once, no? 
-    out_files = []
-    if zip_mode:
+def open_selected_dicoms(dcm, input_root, use_mmap=False):
+    """Yield (file name, size, binary file object) for each selected dicom file.
+
+    Files come from series packs (Pack/Offset/Size columns), zip archives
+    (ZipFile/ArcName columns) or raw files under input_root. With use_mmap,
+    packs, zips and raw files are memory mapped, and stored members are given
+    as mmapio.BufferReader objects over the mapping.
+    """
+    if pack.is_pack_index(dcm):
+        for pk, tab in dcm.groupby("Pack"):
+            in_pack = os.path.join(input_root, pk)
+            with (mmapio.map_file(in_pack) if use_mmap else open(in_pack, "rb")) as pfp:
+                for f, dcmrow in tab.iterrows():
+                    offset, size = int(dcmrow['Offset']), int(dcmrow['Size'])
+                    if use_mmap:
+                        with mmapio.BufferReader(pfp[offset:offset+size]) as fp:
+                            yield os.path.basename(f), size, fp
+                    else:
+                        yield os.path.basename(f), size, pack.read_member(pfp, offset, size)
+    elif ('ZipFile' in dcm.columns) and ('ArcName' in dcm.columns):
         for zf, tab in dcm.groupby("ZipFile"):
             in_zip = os.path.join(input_root, zf)
-            with zipfile.ZipFile(in_zip, "r") as zf:
+            with (mmapio.MappedZip(in_zip) if use_mmap else zipfile.ZipFile(in_zip, "r")) as zf:
                 for f, dcmrow in tab.iterrows():
-                    dcmname = os.path.basename(f)
-                    output_file = os.path.join(output_folder, dcmname)
                     name = dcmrow['ArcName']
-                    with zf.open(name) as f, open(output_file, "wb") as of:
-                        shutil.copyfileobj(f, of)
-                    out_files.append(output_file)
+                    with zf.open(name) as fp:
+                        size = zf.getinfo(name).file_size
+                        yield os.path.basename(f), size, fp
     else:
         for f, dcmrow in dcm.iterrows():
             inpath = os.path.join(input_root, f)
-            dcmname = os.path.basename(f)
-            output_file = os.path.join(output_folder, dcmname)
-            shutil.copy(inpath, output_file)
-            out_files.append(output_file)
+            if use_mmap:
+                with mmapio.map_file(inpath) as view, mmapio.BufferReader(view) as fp:
+                    yield os.path.basename(f), len(view), fp
+            else:
+                with open(inpath, "rb") as fp:
+                    yield os.path.basename(f), os.path.getsize(inpath), fp
+
+def _copy_to(fp, of):
+    if isinstance(fp, mmapio.BufferReader):
+        # A single write straight from the mapping
+        of.write(fp.getbuffer())
+    else:
+        shutil.copyfileobj(fp, of)
 
-    return out_files
+def extract_selected_dicoms(dcm, input_root, output_folder, use_mmap=False):
+    # Delete the output files if they exist
+    if os.listdir(output_folder):
+        for n in os.listdir(output_folder):
+            os.unlink(os.path.join(output_folder, n))
 
+    out_files = []
+    for dcmname, size, fp in open_selected_dicoms(dcm, input_root, use_mmap):
+        output_file = os.path.join(output_folder, dcmname)
+        with open(output_file, "wb") as of:
+            _copy_to(fp, of)
+        out_files.append(output_file)
+
+    return out_files
 
-def filter_impl(input_root, output_root, target_tag, ix, row, dcm):
-    output_folder = os.path.join(output_root, row[target_tag])
-    os.makedirs(output_folder, exist_ok=True)
+def pack_selected_dicoms(dcm, input_root, output_root, name, fmt, use_mmap=False):
+    """Write the selected files as a single series pack, with its sidecar index."""
+    rel_pack = pack.pack_path(name, fmt)
+    pack_file = os.path.join(output_root, rel_pack)
+    os.makedirs(os.path.dirname(pack_file), exist_ok=True)
 
-    out_files = extract_selected_dicoms(dcm, input_root, output_folder)
+    ranges = pack.write_pack(pack_file, open_selected_dicoms(dcm, input_root, use_mmap), fmt)
+    index = pack.make_pack_index(dcmscanner.fix_path(rel_pack), dcmscanner.fix_path(name), ranges)
+    index.to_csv(pack.index_path(pack_file))
+    return rel_pack, index
 
+def filter_impl(input_root, output_root, target_tag, ix, row, dcm, pack_format=None, use_mmap=False):
     orow = row.copy()
-    orow['FileCount'] = len(out_files)
+    if pack_format is None:
+        output_folder = os.path.join(output_root, row[target_tag])
+        os.makedirs(output_folder, exist_ok=True)
+
+        out_files = extract_selected_dicoms(dcm, input_root, output_folder, use_mmap)
+        orow['FileCount'] = len(out_files)
+    else:
+        rel_pack, index = pack_selected_dicoms(dcm, input_root, output_root, row[target_tag], pack_format, use_mmap)
+        orow['FileCount'] = index.shape[0]
+        orow['Pack'] = rel_pack
+
     return orow
 
 @entry.point
 def filter(args):
-    runner = ConvertBatchParRun(filter_impl, args.dicom_root, args.output_root, args.output_column)
-    dcm = pandas.read_csv(args.dicom_index, index_col=0)
+    filter_func = functools.partial(filter_impl, pack_format=args.pack, use_mmap=args.mmap)
+    runner = ConvertBatchParRun(filter_func, args.dicom_root, args.output_root, args.output_column)
+    dcm = load_dicom_index(args.dicom_index)
     convs = pandas.read_csv(args.conversions)
     iter_info = runner.iter_info(convs)
     results = runner.run_from_args(args, iter_args=(iter_info, dcm))
     if args.output_file is not None:
         results.to_csv(args.output_file, index=False)
 
+    if args.pack is not None and args.pack_index is not None:
+        indexes = [pandas.read_csv(pack.index_path(os.path.join(args.output_root, p)), index_col=0) for p in results['Pack']]
+        pandas.concat(indexes, axis=0).to_csv(args.pack_index)
 
-
-
-filter.parser(convert_parser)
+@filter.parser
+def filter_parser(parser):
+    conversion_table_parser(parser)
+    parser.add_argument("--pack", required=False, choices=pack.PACK_FORMATS)
+    parser.add_argument("--pack_index", required=False)
 
 if __name__=="__main__": main()
 
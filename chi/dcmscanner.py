@@ -17,17 +17,26 @@
 #
 #  
 
-from chi import dicom
-from chi.util import EntryPoints, DFBatchParRun
+from chi import dicom, dicomdir, ioorder, mmapio, pack, dirwalk, seriesindex
+from chi.util import EntryPoints, DFBatchParRun, read_table
 
+import argparse
+import ast
+import contextlib
+import datetime
 import fnmatch
 import json
 import pathlib
 import os, os.path
+import posixpath
 import zipfile
 
+import numpy
 import pandas
 import pydicom
+import pydicom.datadict
+import pydicom.multival
+import pydicom.valuerep
 
 from joblib import Parallel, delayed
 
@@ -108,28 +117,149 @@ def use_tag_config(tag_conf):
 
     return results
 
-def get_tag_set_for_args(args):
+def get_special_tag_cases(args):
     special_tag_cases = SPECIAL_TAG_CASES.copy()
     if args.tag_conf is not None:
         tag_conf = use_tag_config(args.tag_conf)
         special_tag_cases.update(tag_conf)
+    return special_tag_cases
+
+def get_tag_set_for_args(args):
+    special_tag_cases = get_special_tag_cases(args)
 
-    tag_string_list = list(handle_tag_list(args.tags))
+    tag_string_list = list(handle_tag_list(args.tags or []))
     name_mapping = {}
     tag_set = read_tagset(tag_string_list, special_cases=special_tag_cases, name_mapping=name_mapping)
     return tag_set, name_mapping
 
-def yield_files(zfpath, tab, tag_set, args):
-    if args.raw_dicom:
-        for f in tab.index:
-            with pydicom.dcmread(os.path.join(args.root, f), stop_before_pixels=True, specific_tags=tag_set) as dcm:
-                yield f, dcm
-    else:
-        with zipfile.ZipFile(zfpath, "r") as zf:
-            for ix, name in tab['ArcName'].items():
-                with zf.open(name) as fp:
-                    with pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=tag_set) as dcm:
-                        yield ix, dcm
+def get_profiles_for_args(args):
+    """{name: (tag set, name mapping)} for the scan --profile options, or None.
+
+    If --tags is also given, it is the profile named ''.
+    """
+    if not args.profile:
+        return None
+    special_tag_cases = get_special_tag_cases(args)
+    profiles = {}
+    if args.tags:
+        profiles[""] = get_tag_set_for_args(args)
+    for name, *tags in args.profile:
+        if name in profiles:
+            raise ValueError(f"Duplicate scan profile {name}")
+        name_mapping = {}
+        tag_set = read_tagset(list(handle_tag_list(tags)), special_cases=special_tag_cases, name_mapping=name_mapping)
+        profiles[name] = (tag_set, name_mapping)
+    return profiles
+
+def profile_path(output_file, name):
+    if not name:
+        return output_file
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}.{name}{ext}"
+
+class DicomReader:
+    """Random access to the headers of the files in one scan group.
+
+    Files are either raw dicoms under args.root (indexed by relative path),
+    members of the zip archive zfpath (located by the ArcName column), or
+    members of the series pack zfpath (located by the Offset and Size columns).
+    The archive is opened once, so the same file can be read several times with
+    different tag sets.
+
+    With args.mmap, archives and raw files are memory mapped, and stored
+    members are parsed in place rather than copied out (see chi.mmapio).
+
+    Raw files are listed by keys() in the physical order given by args.io_order
+    (see chi.ioorder), adding the seek distance before and after reordering to
+    the seek_before and seek_after counts of metrics, if given. With
+    args.fadvise_batch > 0 the kernel is asked to prefetch the next batch of
+    files while the current one is read.
+    """
+    def __init__(self, zfpath, tab, args, metrics=None):
+        self.zfpath = zfpath
+        self.tab = tab
+        self.args = args
+        self.metrics = metrics
+        self.packed = pack.is_pack_index(tab)
+        self._stack = None
+        self._zf = None
+        self._fp = None
+        self._keys = None
+        self._positions = None
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        if self.packed:
+            if self.args.mmap:
+                self._fp = self._stack.enter_context(mmapio.map_file(self.zfpath))
+            else:
+                self._fp = self._stack.enter_context(open(self.zfpath, "rb"))
+        elif not self.args.raw_dicom:
+            if self.args.mmap:
+                self._zf = self._stack.enter_context(mmapio.MappedZip(self.zfpath))
+            else:
+                self._zf = self._stack.enter_context(zipfile.ZipFile(self.zfpath, "r"))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._zf = None
+        self._fp = None
+        self._stack.close()
+
+    def _raw_path(self, ix):
+        return os.path.join(self.args.root, ix)
+
+    def keys(self):
+        if self._keys is None:
+            keys = list(self.tab.index)
+            if self.args.raw_dicom and not self.packed and self.args.io_order != "index":
+                order, before, after = ioorder.physical_order([self._raw_path(ix) for ix in keys], self.args.io_order)
+                keys = [keys[i] for i in order]
+                if self.metrics is not None:
+                    self.metrics["seek_before"] += before
+                    self.metrics["seek_after"] += after
+            self._keys = keys
+            self._positions = {ix: pos for pos, ix in enumerate(keys)}
+        return self._keys
+
+    def _prefetch(self, ix):
+        batch = self.args.fadvise_batch
+        pos = self._positions.get(ix)
+        if pos is None or pos % batch != 0:
+            return
+        start = pos + batch if pos > 0 else 0
+        ioorder.advise_willneed([self._raw_path(k) for k in self._keys[start:pos+2*batch]])
+
+    @contextlib.contextmanager
+    def _open(self, ix):
+        if self._fp is not None:
+            offset, size = int(self.tab.at[ix, 'Offset']), int(self.tab.at[ix, 'Size'])
+            if self.args.mmap:
+                with mmapio.BufferReader(self._fp[offset:offset+size]) as fp:
+                    yield fp
+            else:
+                yield pack.read_member(self._fp, offset, size)
+        elif self._zf is not None:
+            with self._zf.open(self.tab.at[ix, 'ArcName']) as fp:
+                yield fp
+        else:
+            if self.args.fadvise_batch > 0:
+                self.keys()
+                self._prefetch(ix)
+            if self.args.mmap:
+                with mmapio.map_file(self._raw_path(ix)) as view, mmapio.BufferReader(view) as fp:
+                    yield fp
+            else:
+                yield self._raw_path(ix)
+
+    def read(self, ix, tag_set):
+        with self._open(ix) as fp:
+            return pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=tag_set)
+
+def yield_files(zfpath, tab, tag_set, args, metrics=None):
+    with DicomReader(zfpath, tab, args, metrics) as reader:
+        for ix in reader.keys():
+            yield ix, reader.read(ix, tag_set)
 
 def MISSING():
     pass
@@ -142,9 +272,91 @@ def _fix_val(x, missing_val="_chidcm_missing_", empty_val="_chidcm_empty_"):
     else:
         return str(x.value)
 
+INT_VRS = frozenset(("IS", "US", "SS", "UL", "SL", "UV", "SV"))
+FLOAT_VRS = frozenset(("DS", "FL", "FD"))
+TIME_VRS = {"DA": pydicom.valuerep.DA, "DT": pydicom.valuerep.DT, "TM": pydicom.valuerep.TM}
 
+def _typed_val(x):
+    """Like _fix_val, but typed by VR, for scan --typed.
 
-def scan_process_zip(zfname, tab, args, name_mapping, tag_set):
+    Numeric VRs give ints or floats (a tuple of them if multi-valued), DA, DT and
+    TM give dates, datetimes and times, and other multi-valued strings are joined
+    with '\\' as in the file. Missing and empty values are None. Values that
+    don't parse as their VR are kept as strings.
+    """
+    if x is MISSING or x is None or x.is_empty:
+        return None
+    value = x.value
+    multi = isinstance(value, pydicom.multival.MultiValue)
+    try:
+        if x.VR in INT_VRS or x.VR in FLOAT_VRS:
+            conv = int if x.VR in INT_VRS else float
+            return tuple(conv(v) for v in value) if multi else conv(value)
+        if x.VR in TIME_VRS and not multi:
+            return TIME_VRS[x.VR](str(value))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    if multi:
+        return "\\".join(str(v) for v in value)
+    return str(value)
+
+def _value_function(args):
+    return _typed_val if args.typed else _fix_val
+
+def _typed_layout(tag):
+    """The kind of values a tag has with scan --typed, and its column count.
+
+    Both come from the DICOM dictionary only, so every group of a scan gets the
+    same columns and types. Numeric tags with a fixed multiplicity above one are
+    split into that many columns; multi-valued numbers of any other tag are
+    joined with '\\' like strings. Private and unknown tags are strings.
+    """
+    if tag is None or tag.is_private or tag.pydicom() not in pydicom.datadict.DicomDictionary:
+        return "str", None
+    vrs = set(pydicom.datadict.dictionary_VR(tag.pydicom()).split(" or "))
+    vm = pydicom.datadict.dictionary_VM(tag.pydicom())
+    if vrs <= INT_VRS or vrs <= FLOAT_VRS:
+        if not vm.isdigit():
+            return "str", None
+        return ("int" if vrs <= INT_VRS else "float"), (int(vm) if int(vm) > 1 else None)
+    if len(vrs) == 1 and vm == "1" and vrs <= set(TIME_VRS):
+        return vrs.pop(), None
+    return "str", None
+
+def _typed_str(v):
+    if v is None:
+        return None
+    return "\\".join(str(x) for x in v) if isinstance(v, tuple) else str(v)
+
+def typed_table(table, tags_by_name):
+    """Finish a table of _typed_val values.
+
+    Numeric columns of a fixed multiplicity are split into Name_0, Name_1, ...
+    (single values go in Name_0), date and datetime columns become datetime64
+    where they can, values of string columns are made strings, and columns get
+    the narrowest dtype holding their values, with None as a null.
+    """
+    columns = {}
+    for name in table.columns:
+        col = table[name]
+        kind, width = _typed_layout(tags_by_name.get(name))
+        if width is not None:
+            for i in range(width):
+                columns[f"{name}_{i}"] = col.map(lambda v: (v[i] if i < len(v) else None) if isinstance(v, tuple) else (v if i == 0 else None))
+            continue
+        if kind == "str":
+            col = col.map(_typed_str)
+        elif kind in ("DA", "DT") and col.map(lambda v: isinstance(v, datetime.date)).any():
+            try:
+                col = pandas.to_datetime(col)
+            except (TypeError, ValueError):
+                pass
+        columns[name] = col
+    return pandas.DataFrame(columns, index=table.index).infer_objects()
+
+
+
+def scan_process_zip(zfname, tab, args, name_mapping, tag_set, metrics=None):
     tag_to_string = lambda t: name_mapping.get(t, t.tag_string())
 
     if args.group_key == "ZipFile":
@@ -156,17 +368,158 @@ def scan_process_zip(zfname, tab, args, name_mapping, tag_set):
         zfname = zfname[0]
 
     zfpath = os.path.join(args.root, zfname)
-    read_results = {}
-    for ix, dcm in yield_files(zfpath, tab, tag_set, args): 
-        read_results[ix] = {tag_to_string(tag): _fix_val(dcm.get(tag, MISSING)) for tag in tag_set} 
+    filtered_results = {}
+    if args.filter:
+        tab, filtered_results = apply_scan_filter(zfpath, tab, args, tag_to_string, metrics)
+
+    if args.series_aware:
+        read_results = scan_series_aware(zfpath, tab, args, tag_to_string, tag_set, metrics)
+    else:
+        value = _value_function(args)
+        read_results = {}
+        for ix, dcm in yield_files(zfpath, tab, tag_set, args, metrics):
+            read_results[ix] = {tag_to_string(tag): value(dcm.get(tag, MISSING)) for tag in tag_set} 
     #with zipfile.ZipFile(zfpath, "r") as zf:
     #    for ix, name in tab['ArcName'].items():
     #        with zf.open(name) as fp:
     #            with pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=tag_set) as dcm:
     #                read_results[ix] = {tag_to_string(tag): fix_val(dcm.get(tag)) for tag in tag_set} 
 
+    read_results.update(filtered_results)
     return read_results
 
+def scan_filter_tags(expr):
+    """{keyword: Tag} for the names used in a scan filter expression."""
+    tree = ast.parse(expr, mode='eval')
+    names = sorted(set(n.id for n in ast.walk(tree) if isinstance(n, ast.Name)))
+    return {name: dicom.Tag.from_pydicom_attr(name) for name in names}
+
+def apply_scan_filter(zfpath, tab, args, tag_to_string, metrics=None):
+    """Read only the tags used in args.filter, and evaluate it for each file.
+
+    The expression is evaluated with DataFrame.eval over a table of the filter
+    tags, named by keyword, with values as they would appear in the scan output
+    (ie strings, or typed values with args.typed), eg
+    'Modality == "CT" and Manufacturer.str.startswith("GE")'.
+
+    Returns the rows of tab that pass the filter, and the read results to
+    record for those that don't (empty unless args.filter_mode is 'record').
+    """
+    filter_tags = scan_filter_tags(args.filter)
+    value = _value_function(args)
+    values = {}
+    for ix, dcm in yield_files(zfpath, tab, list(filter_tags.values()), args, metrics):
+        values[ix] = {name: value(dcm.get(tag, MISSING)) for name, tag in filter_tags.items()}
+
+    if not values:
+        return tab, {}
+
+    frame = pandas.DataFrame.from_dict(values, orient='index')
+    mask = frame.eval(args.filter, engine='python').astype(bool)
+
+    filtered_results = {}
+    if args.filter_mode == "record":
+        for ix in frame.index[~mask]:
+            filtered_results[ix] = {tag_to_string(filter_tags[name]): val for name, val in values[ix].items()}
+
+    return tab.loc[mask.reindex(tab.index)], filtered_results
+
+def _read_values(dcm, tags, value=_fix_val):
+    return {tag: value(dcm.get(tag, MISSING)) for tag in tags}
+
+def _spread(count, k):
+    """k positions (or fewer) spread evenly over range(count), including the first and last.
+
+    >>> _spread(2, 3), _spread(5, 3), _spread(1, 3), _spread(4, 1)
+    ([0, 1], [0, 2, 4], [0], [0])
+    """
+    k = min(k, count)
+    if k <= 1:
+        return [0][:count]
+    return sorted(set(round(i * (count - 1) / (k - 1)) for i in range(k)))
+
+def scan_series_aware(zfpath, tab, args, tag_to_string, tag_set, metrics=None):
+    """Scan reading series-level tags once per SeriesInstanceUID.
+
+    Every file is read with only the SeriesInstanceUID and the instance-level
+    tags, except while the series of the file before it has fewer than
+    2 * args.series_sample files: then it is read in full, so small series (eg
+    single image CR or DX series), whose files are usually listed together, are
+    read once per file as by a plain scan. args.series_sample files of each
+    series, spread over it (first, middle, last, ...), are also read in full,
+    and the series-level values are copied from those to the files of the
+    series not read in full.
+
+    If args.series_tags is given, the remaining tags are instance-level. Otherwise
+    the classification is made by sampling, per series: a tag is instance-level
+    if it differs between the files read in full. The multi-volume tags
+    (dicom.MULTI_VOLUME_TAGS), which subseries detection relies on, are always
+    instance-level.
+
+    With args.series_check (the default), as many more files spread over the
+    rest of each series are also read in full. If a series-level value does not
+    match, the series is re-read in full.
+    """
+    tag_set = frozenset(tag_set)
+    series_tag = dicom.SERIES_TAG.pydicom()
+    if args.series_tags:
+        series_level = frozenset(args.series_tags) & tag_set
+        sample = 1
+    else:
+        series_level = tag_set - dicom.MULTI_VOLUME_TAGS
+        sample = max(args.series_sample, 1)
+    base_instance_level = tag_set - series_level
+
+    value = _value_function(args)
+    read_results = {}
+    series = {}
+    full = set()
+    with DicomReader(zfpath, tab, args, metrics) as reader:
+        uid = None
+        for ix in reader.keys():
+            in_full = len(series.get(uid, ())) < 2 * sample
+            tags = tag_set if in_full else base_instance_level
+            dcm = reader.read(ix, [series_tag, *tags])
+            uid = _fix_val(dcm.get(series_tag, MISSING))
+            series.setdefault(uid, []).append(ix)
+            read_results[ix] = _read_values(dcm, tags, value)
+            if in_full:
+                full.add(ix)
+
+        for uid, files in series.items():
+            sampled = [files[pos] for pos in _spread(len(files), sample)]
+            for ix in sampled:
+                if ix not in full:
+                    read_results[ix] = _read_values(reader.read(ix, tag_set), tag_set, value)
+                    full.add(ix)
+            rest = [ix for ix in files if ix not in full]
+            if not rest:
+                continue
+            series_values = read_results[sampled[0]]
+            instance_level = set(base_instance_level)
+            instance_level.update(t for ix in files if ix in full for t in tag_set if read_results[ix][t] != series_values[t])
+
+            # Tags found to vary while sampling weren't read for the rest of the series
+            extra = instance_level - base_instance_level
+            for ix in rest:
+                values = {t: series_values[t] for t in tag_set - instance_level}
+                values.update(read_results[ix])
+                if extra:
+                    values.update(_read_values(reader.read(ix, extra), extra, value))
+                read_results[ix] = values
+
+            if args.series_check:
+                for ix in [rest[pos] for pos in _spread(len(rest), sample)]:
+                    values = _read_values(reader.read(ix, tag_set), tag_set, value)
+                    mismatch = [t for t in tag_set - instance_level if values[t] != read_results[ix][t]]
+                    if mismatch:
+                        print(f"Series {uid} in {zfpath} has inconsistent series-level tags {[tag_to_string(t) for t in mismatch]}, reading in full")
+                        for ix in rest:
+                            read_results[ix] = _read_values(reader.read(ix, tag_set), tag_set, value)
+                        break
+
+    return {ix: {tag_to_string(tag): val for tag, val in values.items()} for ix, values in read_results.items()}
+
 def make_empty_df(index_cols, col_names):
     if len(index_cols) > 1:
         ix = pandas.MultiIndex.from_arrays([[]]*len(index_cols), names=index_cols)
@@ -186,7 +539,12 @@ def make_df_from_result_dict(read_results, args, tag_labels):
     return new_results
 
 def load_index(args):
-    index = pandas.read_csv(args.index, index_col=0, dtype=str)
+    index = read_table(args.index, index_col=0, dtype=str)
+    under = getattr(args, "under", None)
+    if under:
+        prefixes = [u.strip("/") for u in under]
+        if "" not in prefixes:
+            index = index.loc[index.index.str.startswith(tuple(f"{p}/" for p in prefixes))]
     return index
 
 def reduce_table_for_batch(index, args):
@@ -198,39 +556,224 @@ def reduce_table_for_batch(index, args):
 
     return index
 
-def scan_process_zip_wrapper(bpr, zf_tab, args, name_mapping, tag_set):
-    result = scan_process_zip(zf_tab[0], zf_tab[1], args, name_mapping, tag_set)
-    result = zf_tab[1].join(pandas.DataFrame.from_dict(result, orient='index'), validate='one_to_one', how='inner')
-    return bpr.table(result)
+def _scan_result_table(tab, result, name_mapping, tag_set, args):
+    if args.typed:
+        result = typed_table(result, {name_mapping.get(t, t.tag_string()): t for t in tag_set})
+    # Scanned values take precedence over columns already in the index (eg from a DICOMDIR)
+    tab = tab.drop(columns=tab.columns.intersection(result.columns))
+    return tab.join(result, validate='one_to_one', how='inner')
+
+def _profile_result(result, name_mapping, tag_set):
+    """The columns of a scan by tag string for one profile, named by its name_mapping."""
+    columns = {t.tag_string(): name_mapping.get(t, t.tag_string()) for t in sorted(tag_set)}
+    return result.reindex(columns=list(columns)).rename(columns=columns)
+
+def scan_process_zip_wrapper(bpr, zf_tab, args, name_mapping, tag_set, profiles=None):
+    result = scan_process_zip(zf_tab[0], zf_tab[1], args, name_mapping, tag_set, bpr.task_metrics)
+    result = pandas.DataFrame.from_dict(result, orient='index')
+    if profiles is None:
+        return bpr.table(_scan_result_table(zf_tab[1], result, name_mapping, tag_set, args))
+
+    # Columns are (profile, name) pairs, split up again by scan
+    tables = {}
+    for name, (profile_tags, profile_mapping) in profiles.items():
+        profile_result = _profile_result(result, profile_mapping, profile_tags)
+        tables[name] = _scan_result_table(zf_tab[1], profile_result, profile_mapping, profile_tags, args)
+    return bpr.table(pandas.concat(tables, axis=1))
+
+def _add_filter_tags(tag_set, name_mapping, filter_tags):
+    for name, tag in filter_tags.items():
+        name_mapping.setdefault(tag, name)
+    return tag_set.union(filter_tags.values())
+
+def prepare_scan_args(args):
+    """The tag set to read, its name mapping, and the profiles (or None).
+
+    With profiles, the tag set is the union of the profiles' tags, and the name
+    mapping is empty, so results are named by tag string until split by profile.
+    """
+    if not args.tags and not args.profile:
+        raise ValueError("scan needs --tags or --profile")
+    profiles = get_profiles_for_args(args)
+    tag_set, name_mapping = get_tag_set_for_args(args)
+    filter_tags = scan_filter_tags(args.filter) if args.filter else {}
+    # Filter tags are always part of the output
+    tag_set = _add_filter_tags(tag_set, name_mapping, filter_tags)
+    if profiles is not None:
+        for name, (profile_tags, profile_mapping) in profiles.items():
+            profiles[name] = (_add_filter_tags(profile_tags, profile_mapping, filter_tags), profile_mapping)
+        tag_set = frozenset().union(*(t for t, _ in profiles.values()))
+        name_mapping = {}
+    if args.series_tags:
+        args.series_tags = read_tagset(list(handle_tag_list(args.series_tags)), special_cases=get_special_tag_cases(args))
+    return tag_set, name_mapping, profiles
+
+def scan_options(**kwargs):
+    """An args namespace for scan, with the command line defaults updated by kwargs."""
+    parser = argparse.ArgumentParser()
+    scan_parser(parser)
+    for action in parser._actions:
+        action.required = False
+    args = parser.parse_args([])
+    for k, v in kwargs.items():
+        if not hasattr(args, k):
+            raise TypeError(f"Unknown scan option {k}")
+        setattr(args, k, v)
+    return args
+
+_ARROW_TYPED = {"int": "int64", "float": "float64", "DA": "timestamp[us]", "DT": "timestamp[us]", "TM": "time64[us]"}
+
+def scan_arrow_schema(index, tag_set, name_mapping, typed=False):
+    """The pyarrow schema of scan results for index, as iter_scan yields them.
+
+    The columns of index not replaced by a tag, then the tags (strings, or with
+    typed their _typed_layout types and columns), then the file name index.
+    """
+    import pyarrow
+    fields = {}
+    for tag in sorted(tag_set):
+        name = name_mapping.get(tag, tag.tag_string())
+        kind, width = _typed_layout(tag) if typed else ("str", None)
+        arrow_type = pyarrow.type_for_alias(_ARROW_TYPED.get(kind, "string"))
+        for column in ([f"{name}_{i}" for i in range(width)] if width is not None else [name]):
+            fields[column] = arrow_type
+    index_fields = []
+    for field in pyarrow.Schema.from_pandas(index.iloc[:0], preserve_index=False):
+        if field.name not in fields:
+            # Empty and string columns may come out as null or large_string
+            string = pyarrow.types.is_null(field.type) or pyarrow.types.is_large_string(field.type)
+            index_fields.append(pyarrow.field(field.name, pyarrow.string() if string else field.type))
+    file_name = index.index.name if index.index.name is not None else "__index_level_0__"
+    return pyarrow.schema([*index_fields, *fields.items(), (file_name, pyarrow.string())])
+
+def _to_record_batch(table, schema):
+    import pyarrow
+    batch = pyarrow.RecordBatch.from_pandas(table[[c for c in schema.names if c in table.columns]], preserve_index=True)
+    arrays = []
+    for field in schema:
+        column = batch.column(field.name) if field.name in batch.schema.names else None
+        # Groups may lack columns (eg where no file passed a record filter), or
+        # have no values in them
+        if column is None or column.null_count == len(column):
+            arrays.append(pyarrow.nulls(batch.num_rows, field.type))
+        else:
+            arrays.append(column.cast(field.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema.with_metadata(batch.schema.metadata))
+
+def iter_scan(index, tags, n_jobs=1, output_format="pandas", ordered=False, **options):
+    """Scan the files of index, yielding the result for each group as it finishes.
+
+    index is a file index as produced by zip_archive_index or dicom_search, and
+    tags a list of tag strings as accepted by scan --tags. options are any other
+    scan command line options (root, group_key, raw_dicom, tag_conf, ...). Each
+    item is the table scan would write for one group, either as a pandas
+    DataFrame or, with output_format="arrow", as a pyarrow RecordBatch. The
+    batches all have the scan_arrow_schema of the scan, so they can be put in
+    one pyarrow Table.
+
+    With the profile option (a list of [name, tag, ...] lists), the pandas
+    columns are (profile name, column) pairs, the tags argument being the
+    profile named ''. Groups are sent to the workers one per task, unless the
+    task_batch option is given.
+    """
+    if output_format not in ("pandas", "arrow"):
+        raise ValueError(f"Unknown output format {output_format}")
+
+    args = scan_options(tags=list(tags), **options)
+    tag_set, name_mapping, profiles = prepare_scan_args(args)
+    if profiles is not None and output_format == "arrow":
+        raise ValueError("Scan profiles are only supported with pandas output")
+
+    if output_format == "arrow":
+        schema = scan_arrow_schema(index, tag_set, name_mapping, typed=args.typed)
+    bpr = DFBatchParRun.from_function(scan_process_zip_wrapper)
+    info = bpr.iter_info(index, group_key=args.group_key)
+    # Not the command line's auto default
+    batch_size = options.get("task_batch", 1)
+    for table in bpr.iter_parallel(n_jobs=n_jobs, iter_args=(info,), execute_args=(args, name_mapping, tag_set, profiles), ordered=ordered, batch_size=batch_size):
+        if output_format == "arrow":
+            yield _to_record_batch(table, schema)
+        else:
+            yield table
 
 @entry.point
 def scan(args):
-    tag_set, name_mapping = get_tag_set_for_args(args)
-    print(name_mapping)
+    tag_set, name_mapping, profiles = prepare_scan_args(args)
+    if profiles is None:
+        print(name_mapping)
 
     #read_results = {}
     index = load_index(args)
     bpr = DFBatchParRun.from_function(scan_process_zip_wrapper)
     info = bpr.iter_info(index, group_key=args.group_key)
-    table = bpr.run_from_args(args, iter_args=(info,), execute_args=(args, name_mapping, tag_set))
-    if args.output_file is not None:
+    table = bpr.run_from_args(args, iter_args=(info,), execute_args=(args, name_mapping, tag_set, profiles))
+    if "seek_before" in bpr.metrics:
+        before, after = bpr.metrics["seek_before"], bpr.metrics["seek_after"]
+        saved = 100 * (1 - after / before) if before else 0.0
+        print(f"{args.io_order} order: seek distance {before} -> {after} ({saved:0.1f}% saved)")
+    if args.output_file is None:
+        return
+    if profiles is None:
         table.to_csv(args.output_file)
+        return
+    for name, (_, profile_mapping) in profiles.items():
+        print(f"Profile {name or '(--tags)'}: {profile_mapping}")
+        profile_table = table[name] if name in table.columns.get_level_values(0) else table.iloc[:, :0]
+        profile_table.to_csv(profile_path(args.output_file, name))
 
 @scan.parser
 def scan_parser(parser):
     DFBatchParRun.update_parser(parser)
     parser.add_argument("--root", required=True)
     parser.add_argument("--output_file", required=True)
-    parser.add_argument("--tags", nargs="+", required=True, action='extend')
+    parser.add_argument("--tags", nargs="+", required=False, action='extend')
+    parser.add_argument("--profile", nargs="+", required=False, action='append', metavar=("NAME", "TAG"), help="A named tag profile, written to the output file with .NAME before its extension. Files are read once for all profiles. May be repeated.")
     parser.add_argument("--index", required=True)
+    parser.add_argument("--under", nargs="+", required=False, help="Only scan files in or under these directories of the index.")
     parser.add_argument("--tag_conf", required=False)
     parser.add_argument("--group_key", required=False, default="ZipFile")
     parser.add_argument("--raw_dicom", action='store_true')
+    parser.add_argument("--series_aware", action='store_true')
+    parser.add_argument("--series_tags", nargs="+", required=False, action='extend')
+    parser.add_argument("--series_sample", required=False, type=int, default=3)
+    parser.add_argument("--series_check", action=argparse.BooleanOptionalAction, default=True, help="Check series-level values against more files of each series, re-reading series that don't match (on by default).")
+    parser.add_argument("--mmap", action='store_true')
+    parser.add_argument("--io_order", required=False, choices=ioorder.IO_ORDERS, default="index")
+    parser.add_argument("--fadvise_batch", required=False, type=int, default=0)
+    parser.add_argument("--filter", required=False)
+    parser.add_argument("--typed", action='store_true', help="Typed values by VR: numbers, dates, and numbers of a fixed multiplicity split into Name_0, Name_1, ... columns, with nulls for missing and empty values.")
+    parser.add_argument("--filter_mode", required=False, choices=["skip", "record"], default="skip")
 
 def fix_path(path):
     return pathlib.Path(path).as_posix()
 
-def zip_archive_index_process(z, relz):
+def zip_dicomdir_index(zf, names, zdir, relz):
+    """Index of the members listed by the DICOMDIRs in zf, or None if it has none."""
+    dicomdirs = [n for n in names if dicomdir.is_dicomdir_name(n)]
+    if not dicomdirs:
+        return None
+
+    by_upper = {n.upper(): n for n in names}
+    rows = {}
+    for dd in dicomdirs:
+        base = posixpath.dirname(dd)
+        with zf.open(dd) as fp:
+            records = dicomdir.read_dicomdir(fp)
+        for rec in records:
+            ref = posixpath.join(base, rec.pop("ReferencedFileID"))
+            name = by_upper.get(ref.upper())
+            if name is None:
+                print(f"DICOMDIR {dd} in {relz} lists missing member {ref}")
+                continue
+            rows[name] = rec
+
+    names = list(rows)
+    index = pandas.Index([fix_path(os.path.join(zdir, name)) for name in names], name="FileName")
+    df = pandas.DataFrame({"ZipFile": [relz]*len(index), "ArcName": names}, index=index)
+    columns = pandas.DataFrame.from_records([rows[n] for n in names], index=index, columns=list(dicomdir.COLUMNS))
+    return df.join(columns)
+
+def zip_archive_index_process(z, relz, use_dicomdir=False):
     zdir = os.path.dirname(relz)
     try:
         zf = zipfile.ZipFile(z, "r")
@@ -240,10 +783,15 @@ def zip_archive_index_process(z, relz):
     
     with zf:
         names = zf.namelist()
+        if use_dicomdir:
+            df = zip_dicomdir_index(zf, names, zdir, relz)
+            if df is not None:
+                return df
         # TODO Make this configurable
         names = [n for n in names if n.endswith(".dcm")]
-        full_index = [fix_path(os.path.join(zdir, name)) for name in names]
-        index = pandas.Index(full_index, name="FileName")
+        # Member names are already '/' separated, so only the prefix needs fixing
+        prefix = fix_path(zdir) + "/" if zdir else ""
+        index = pandas.Index([prefix + name for name in names], name="FileName")
         df = pandas.DataFrame({"ZipFile": [relz]*len(index), "ArcName": names}, index=index)
         return df
 
@@ -251,7 +799,7 @@ def zip_archive_index_process_wrapper(bpr, arg, args):
     ix, arg = arg
     z = arg['ZipFile']
     relz = fix_path(os.path.relpath(z, args.root))
-    table = zip_archive_index_process(z, relz)
+    table = zip_archive_index_process(z, relz, args.use_dicomdir)
     return bpr.table(table)
     
 @entry.point
@@ -280,6 +828,7 @@ def zip_archive_index_parser(parser):
 
     parser.add_argument("--root", required=True)
     parser.add_argument("--output_file", required=True)
+    parser.add_argument("--use_dicomdir", action='store_true')
     #parser.add_argument("--reread_all", action='store_true')
 
 @entry.point
@@ -309,6 +858,114 @@ def index_info_parser(parser):
     parser.add_argument("--index", required=True)
     parser.add_argument("--batch_size", required=False, type=int, default=0)
 
+@entry.point
+def partition_index(args):
+    # Read as text, so values are written back exactly as they were
+    table = pandas.read_csv(args.index, index_col=0, dtype=str, keep_default_na=False)
+    # The types a plain read of the whole table infers, for reads of a few buckets
+    dtypes = seriesindex.inferred_dtypes(table)
+    footer = seriesindex.write_partitioned(table, args.output_file, buckets=args.buckets, dtypes=dtypes)
+    print(f"Wrote {table.shape[0]} rows in {len(footer['parts'])} buckets")
+
+@partition_index.parser
+def partition_index_parser(parser):
+    parser.add_argument("--index", required=True)
+    parser.add_argument("--output_file", required=True)
+    parser.add_argument("--buckets", required=False, type=int, default=seriesindex.DEFAULT_BUCKETS)
+
+SOP_INSTANCE_UID = "SOPInstanceUID"
+
+def duplicates_path(output_file):
+    name, ext = os.path.splitext(output_file)
+    return f"{name}.duplicates{ext}"
+
+def zip_member_checksums(index, root):
+    """CRC and FileSize columns for the zip members of index, from the central directories."""
+    crcs = pandas.Series(0, index=index.index, dtype="int64")
+    sizes = pandas.Series(0, index=index.index, dtype="int64")
+    for zfname, tab in index.groupby('ZipFile'):
+        with zipfile.ZipFile(os.path.join(root, zfname), "r") as zf:
+            infos = [zf.getinfo(name) for name in tab['ArcName']]
+        crcs.loc[tab.index] = [info.CRC for info in infos]
+        sizes.loc[tab.index] = [info.file_size for info in infos]
+    return pandas.DataFrame({"CRC": crcs, "FileSize": sizes})
+
+def raw_file_sizes(index, root):
+    sizes = [os.path.getsize(os.path.join(root, f)) for f in index['FileName']]
+    return pandas.DataFrame({"FileSize": sizes}, index=index.index)
+
+def find_duplicates(index, key_cols, order_cols):
+    """Split index into canonical rows and a map from duplicate to canonical rows.
+
+    Rows with the same values in key_cols are copies of the same instance; the
+    first by order_cols is canonical. Rows with a missing SOPInstanceUID are
+    always canonical.
+    """
+    ordered = index.sort_values(order_cols, kind='stable')
+    missing = ordered[SOP_INSTANCE_UID].isin(["_chidcm_missing_", "_chidcm_empty_"]) | ordered[SOP_INSTANCE_UID].isna()
+    duplicated = ordered.duplicated(key_cols, keep='first') & ~missing
+
+    canonical = ordered.loc[~duplicated].sort_index()
+    canonical_for_key = ordered.loc[~duplicated & ~missing].set_index(key_cols)[order_cols]
+    dups = ordered.loc[duplicated]
+    dup_map = dups.join(canonical_for_key, on=key_cols, rsuffix="Canonical")
+    return canonical, dup_map
+
+@entry.point
+def dedup(args):
+    """Drop copies of the same SOPInstanceUID from a file index.
+
+    The SOPInstanceUID column is used if index has one (eg a scan output), and
+    is otherwise read from every file. With --confirm_crc, copies must also
+    have the same CRC and size in their zip central directory (or the same size,
+    for raw files); an instance whose copies differ is kept in every variant.
+    The canonical index is written to --output_file, and the map from each
+    dropped copy to its canonical copy alongside it.
+    """
+    index = load_index(args)
+    ixname = index.index.name
+    index_cols = list(index.columns)
+    work = index.reset_index()
+
+    if SOP_INSTANCE_UID not in work.columns:
+        options = dict(root=args.root, group_key=args.group_key, raw_dicom=args.raw_dicom, mmap=args.mmap)
+        sop = pandas.concat(iter_scan(index, [SOP_INSTANCE_UID], n_jobs=args.jobs, ordered=True, **options), axis=0)
+        # Align by position within each group, since FileName is not unique across archives
+        sop = sop.reset_index().set_index([ixname, args.group_key])[SOP_INSTANCE_UID]
+        work[SOP_INSTANCE_UID] = sop.reindex(pandas.MultiIndex.from_frame(work[[ixname, args.group_key]])).values
+
+    key_cols = [SOP_INSTANCE_UID]
+    if args.confirm_crc:
+        if args.raw_dicom:
+            checks = raw_file_sizes(work.rename(columns={ixname: 'FileName'}), args.root)
+        else:
+            checks = zip_member_checksums(work, args.root)
+        work = work.join(checks)
+        key_cols += list(checks.columns)
+
+        variants = work.groupby(SOP_INSTANCE_UID)[list(checks.columns)].nunique().max(axis=1)
+        conflicts = int((variants > 1).sum())
+        if conflicts:
+            print(f"{conflicts} SOPInstanceUIDs have copies with different content, keeping all variants")
+
+    order_cols = [c for c in (args.group_key, ixname, 'ArcName') if c in work.columns]
+    canonical, dup_map = find_duplicates(work, key_cols, list(dict.fromkeys(order_cols)))
+    print(f"{dup_map.shape[0]} duplicate files of {work.shape[0]}")
+
+    canonical.set_index(ixname)[index_cols].to_csv(args.output_file)
+    dup_map.set_index(ixname).to_csv(duplicates_path(args.output_file))
+
+@dedup.parser
+def dedup_parser(parser):
+    parser.add_argument("--root", required=True)
+    parser.add_argument("--index", required=True)
+    parser.add_argument("--output_file", required=True)
+    parser.add_argument("--group_key", required=False, default="ZipFile")
+    parser.add_argument("--raw_dicom", action='store_true')
+    parser.add_argument("--mmap", action='store_true')
+    parser.add_argument("--confirm_crc", action='store_true')
+    parser.add_argument("--jobs", default=-1, type=int)
+
 #@entry.add_common_parser
 #def common_parser(parser):
 #    parser.add_argument("--jobs", type=int, default=1)
@@ -341,27 +998,68 @@ def is_dicom(f, parse=False):
     else:
         return f.endswith(".dcm")
 
+def resolve_path_case(base, parts):
+    """Join parts to base, matching each part case-insensitively if needed."""
+    path = base
+    for part in parts:
+        candidate = os.path.join(path, part)
+        if not os.path.exists(candidate):
+            matches = [n for n in os.listdir(path) if n.upper() == part.upper()] if os.path.isdir(path) else []
+            if not matches:
+                return None
+            candidate = os.path.join(path, matches[0])
+        path = candidate
+    return path
+
+def split_dicomdir_files(files):
+    """DICOMDIR files among files, and the files not under a directory with one."""
+    dicomdirs = [f for f in files if dicomdir.is_dicomdir_name(f)]
+    roots = tuple(os.path.join(os.path.dirname(d), "") for d in dicomdirs)
+    rest = [f for f in files if not dicomdir.is_dicomdir_name(f) and not f.startswith(roots)]
+    return dicomdirs, rest
+
+def dicomdir_file_rows(dicomdir_path, root):
+    """{relative path: columns} for the instances listed by a DICOMDIR on disk."""
+    base = os.path.dirname(dicomdir_path)
+    rows = {}
+    for rec in dicomdir.read_dicomdir(dicomdir_path):
+        path = resolve_path_case(base, rec.pop("ReferencedFileID").split("/"))
+        if path is None:
+            print(f"DICOMDIR {dicomdir_path} lists a missing file")
+            continue
+        rows[fix_path(os.path.relpath(path, root))] = rec
+    return rows
+
 def dicom_recursive_search(bpr, arg, cmdargs):
     ix, row = arg
     sdir = row['Subdirectory']
     root = cmdargs.root
 
-    files = dicom.list_files(os.path.join(root, sdir))
-    
-    rel_files = []
-    for f in files:
-        if is_dicom(f):
-            relf = fix_path(os.path.relpath(f, root))
-            rel_files.append(relf)
+    paths = dirwalk.DirListing.from_walk(os.path.join(root, sdir), prefix=fix_path(sdir))
+    names = paths.names.categories
+    keep = numpy.array([is_dicom(n) for n in names], dtype=bool)[paths.names.codes]
+    dicomdir_rows = {}
+    if cmdargs.use_dicomdir:
+        # Files under a directory with a DICOMDIR are indexed from it
+        is_dicomdir = numpy.array([dicomdir.is_dicomdir_name(n) for n in names], dtype=bool)[paths.names.codes]
+        full_paths = paths.paths(root)
+        for pos in numpy.flatnonzero(is_dicomdir):
+            dicomdir_rows.update(dicomdir_file_rows(full_paths[pos], root))
+        keep &= ~paths.under(*(paths.dirs[c] for c in set(paths.dir_codes[is_dicomdir])))
+
+    rel_files = list(paths.paths()[keep])
 
     tab = pandas.Series(sdir, index=rel_files).to_frame("Subdirectory")
+    if dicomdir_rows:
+        listed = pandas.DataFrame.from_dict(dicomdir_rows, orient='index', columns=list(dicomdir.COLUMNS))
+        listed.insert(0, "Subdirectory", sdir)
+        tab = pandas.concat([listed, tab], axis=0)
     tab.index.name = "File"
     return bpr.table(tab)
 
 def full_file_list(root):
-    files = dicom.list_files(root)
-    rel_path = [fix_path(os.path.relpath(f, root)) for f in files]
-    return pandas.Series(files, index=rel_path).to_frame("FilePath")
+    paths = dirwalk.DirListing.from_walk(root)
+    return pandas.Series(paths.paths(root), index=paths.paths()).to_frame("FilePath")
 
 def dicom_file_check(bpr, arg, cmdargs):
     chunk, tab = arg
@@ -371,7 +1069,10 @@ def dicom_file_check(bpr, arg, cmdargs):
         full_path = row['FilePath']
         
 
-        if is_dicom(full_path, cmdargs.check_dicom_parse):
+        if cmdargs.use_dicomdir and dicomdir.is_dicomdir_name(full_path):
+            for relf, columns in dicomdir_file_rows(full_path, cmdargs.root).items():
+                dcms.append(dict(File=relf, Subdirectory=os.path.dirname(relf), **columns))
+        elif is_dicom(full_path, cmdargs.check_dicom_parse):
             dcms.append(dict(File=rel_path, Subdirectory=os.path.dirname(rel_path)))
     if dcms:
         return bpr.table(pandas.DataFrame.from_records(dcms, index="File"))  
@@ -393,7 +1094,18 @@ def dicom_search(args):
         directories = full_file_list(args.root)
         print(f"Found total of {directories.shape[0]} files")
         bpr = DFBatchParRun.from_function(dicom_file_check)
-        directories['ChunkLabel'] = pandas.Series(dict(zip(directories.index, chunker(args.chunk_size))))
+        if args.use_dicomdir:
+            # Files under a DICOMDIR are indexed from it, so they are dropped, and
+            # each DICOMDIR gets a chunk of its own
+            dicomdirs, rest = split_dicomdir_files(list(directories['FilePath']))
+            is_dicomdir = directories['FilePath'].isin(dicomdirs)
+            labels = dict(zip(directories.index[directories['FilePath'].isin(rest)], chunker(args.chunk_size)))
+            labels.update(zip(directories.index[is_dicomdir], itertools.count(-len(dicomdirs))))
+            directories = directories.loc[directories.index.isin(list(labels))].copy()
+            print(f"Indexing {is_dicomdir.sum()} DICOMDIRs, and checking {len(rest)} other files")
+            directories['ChunkLabel'] = pandas.Series(labels)
+        else:
+            directories['ChunkLabel'] = pandas.Series(dict(zip(directories.index, chunker(args.chunk_size))))
         info = bpr.iter_info(directories, 'ChunkLabel')
         
     
@@ -413,5 +1125,6 @@ def dicom_search_parser(parser):
     parser.add_argument("--chunk_size", required=False, type=int, default=500)
     parser.add_argument("--output_file", required=False)
     parser.add_argument("--check_dicom_parse", action='store_true')
+    parser.add_argument("--use_dicomdir", action='store_true')
 
 if __name__=="__main__": main()
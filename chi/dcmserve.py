@@ -0,0 +1,161 @@
+# A long running server for scan, convert and filter jobs.
+#
+# Each command line invocation pays for interpreter start up, importing pandas,
+# SimpleITK and pydicom, parsing the index csv and spawning joblib workers. The
+# serve command pays these once: it keeps parsed index tables in memory (re-read
+# only when the file changes) and a warm worker pool, and runs jobs sent to it
+# over a unix socket by the submit command. Jobs run one at a time, in the
+# working directory of the submitter, with the same arguments as the command line.
+
+from chi.util import EntryPoints, Tic, enable_table_cache
+from chi import dcmconvert, dcmscanner
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+entry = EntryPoints()
+
+DEFAULT_SOCKET = "chi-dicom.sock"
+JOB_ENTRIES = (dcmscanner.entry, dcmconvert.entry)
+
+def _add_socket_arg(parser):
+    parser.add_argument("--socket", default=os.environ.get("CHI_DICOM_SOCKET", DEFAULT_SOCKET), help="Path of the server's unix socket.")
+
+def job_entry(name):
+    for ep in JOB_ENTRIES:
+        if name in ep.names():
+            return ep
+    raise ValueError(f"Unknown command {name}")
+
+def run_job(argv, cwd):
+    """Run a command line in cwd, returning (ok, captured output)."""
+    out = io.StringIO()
+    ok = False
+    old_cwd = os.getcwd()
+    tic = Tic()
+    try:
+        # Only stdout is captured; convert redirects the stderr file descriptor
+        # itself, and warnings are left to the server's log
+        with contextlib.redirect_stdout(out):
+            try:
+                os.chdir(cwd)
+                ep = job_entry(argv[0] if argv else None)
+                with contextlib.redirect_stderr(out):
+                    # Usage errors from argparse go back to the submitter
+                    args = ep.parse_args(argv)
+                args.cmd(args)
+                print(f"Ran in {tic.toc():0.05f} seconds")
+                ok = True
+            except SystemExit as e:
+                # argparse exits on --help (code 0) and on bad arguments
+                ok = not e.code
+            except Exception:
+                traceback.print_exc(file=out)
+    finally:
+        os.chdir(old_cwd)
+    return ok, out.getvalue()
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+def _receive(fp):
+    line = fp.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    return json.loads(line)
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = _receive(self.rfile)
+        except (ConnectionError, ValueError):
+            return
+        argv = request.get("argv", [])
+        if argv == ["shutdown"]:
+            _send(self.connection, {"ok": True, "output": "Server shutting down\n"})
+            # shutdown() waits for serve_forever, so can't be called from this thread
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        ok, output = run_job(argv, request.get("cwd", os.getcwd()))
+        print(f"{'done' if ok else 'FAILED'}: {' '.join(argv)}", flush=True)
+        _send(self.connection, {"ok": ok, "output": output})
+
+# Workers idle for longer than this exit, and the next job starts new ones
+WORKER_IDLE_TIMEOUT = 7 * 24 * 3600
+
+def _import_job_modules():
+    # Run by each worker as it starts, rather than by the first task it gets
+    import pandas, pydicom, SimpleITK
+    from chi import dcmconvert, dcmscanner
+
+def worker_config():
+    """joblib configuration for the server's jobs: loky workers that import the
+    job modules when they start, and stay up between jobs."""
+    from joblib import parallel_config
+    return parallel_config(backend="loky", idle_worker_timeout=WORKER_IDLE_TIMEOUT, initializer=_import_job_modules)
+
+def warm_pool(n_jobs):
+    """Start the joblib worker processes, so the first job doesn't pay for it.
+
+    Must run under worker_config, as jobs do, for them to reuse the workers.
+    """
+    if n_jobs == 1:
+        return
+    from joblib import Parallel, delayed
+    Parallel(n_jobs=n_jobs)(delayed(os.getpid)() for _ in range(2 * n_jobs))
+
+@entry.point
+def serve(args):
+    if os.path.exists(args.socket):
+        # A socket left behind by a server that died
+        with socket.socket(socket.AF_UNIX) as probe:
+            if probe.connect_ex(args.socket) == 0:
+                raise RuntimeError(f"A server is already listening on {args.socket}")
+        os.unlink(args.socket)
+
+    enable_table_cache()
+    # Jobs run in this thread, which parallel_config applies to
+    with worker_config():
+        warm_pool(args.jobs)
+        with socketserver.UnixStreamServer(args.socket, _JobHandler) as server:
+            print(f"Listening on {args.socket}", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(args.socket)
+
+@serve.parser
+def serve_parser(parser):
+    _add_socket_arg(parser)
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes to keep warm. Should match the --jobs of submitted jobs.")
+
+@entry.point
+def submit(args):
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(args.socket)
+        _send(sock, {"cwd": os.getcwd(), "argv": args.job})
+        with sock.makefile("rb") as fp:
+            response = _receive(fp)
+    sys.stdout.write(response["output"])
+    if not response["ok"]:
+        sys.exit(1)
+
+@submit.parser
+def submit_parser(parser):
+    _add_socket_arg(parser)
+    parser.add_argument("job", nargs=argparse.REMAINDER, help="Command and arguments, as given to chi.dcmscanner or chi.dcmconvert, or shutdown.")
+
+def main():
+    entry.main()
+
+if __name__=="__main__": main()
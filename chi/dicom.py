@@ -1,5 +1,6 @@
 
 import collections
+import contextlib
 import fnmatch
 import os, os.path
 
@@ -83,27 +84,43 @@ def scan_files_pydicom(files, tags, tag_to_string=lambda t: t.tag_string()):
 
     return pandas.DataFrame.from_dict(results, orient='index')
 
-def scan_files(files, tags, tag_to_string=lambda t: t.tag_string(), pydcm_backend=False, use_tqdm=False):
+def _scan_files_gdcm_columns(files, tags):
+    """Scan files with gdcm, returning {tag: list of values in file order}."""
+    scanner = _prep_gdcm_scanner(tags)
+    succ = scanner.Scan(files)
+    if not succ:
+        raise RuntimeError("Scanner Failure!")
+
+    columns = {}
+    for tag in tags:
+        gtag = tag.gdcm()
+        values = (scanner.GetValue(file, gtag) for file in files)
+        columns[tag] = ["" if value is None else value.strip() for value in values]
+    return columns
+
+def scan_files(files, tags, tag_to_string=lambda t: t.tag_string(), pydcm_backend=False, use_tqdm=False, n_jobs=1, chunk_size=2000):
+    """Scan tags from files into a table indexed by file.
+
+    With the gdcm backend and n_jobs != 1, file lists longer than chunk_size are
+    split into chunks, scanned in parallel processes, and merged column-wise.
+    """
     if pydcm_backend:
         if use_tqdm:
             from tqdm import tqdm
             files = tqdm(files)
         return scan_files_pydicom(files, tags, tag_to_string)
-    scanner = _prep_gdcm_scanner(tags)
-    succ = scanner.Scan(files)
-    if not succ:
-        raise RuntimeError("Scanner Failure!")
 
-    results = {}
-    for file in files:
-        for tag in tags:
-            value = scanner.GetValue(file, tag.gdcm())
-            if value is None:
-                value = ""
-            value = value.strip()
-            results.setdefault(file, {})[tag_to_string(tag)] = value
+    files = list(dict.fromkeys(files))
+    tags = list(tags)
+    if n_jobs != 1 and len(files) > chunk_size:
+        from joblib import Parallel, delayed
+        chunks = [files[start:start+chunk_size] for start in range(0, len(files), chunk_size)]
+        chunk_columns = Parallel(n_jobs=n_jobs)(delayed(_scan_files_gdcm_columns)(chunk, tags) for chunk in chunks)
+        columns = {tag: [value for cols in chunk_columns for value in cols[tag]] for tag in tags}
+    else:
+        columns = _scan_files_gdcm_columns(files, tags)
 
-    return pandas.DataFrame.from_dict(results, orient='index')
+    return pandas.DataFrame({tag_to_string(tag): columns[tag] for tag in tags}, index=files)
 
 def check_has_tags(scan_result, tags):
     if len(tags) > 1:
@@ -163,14 +180,204 @@ def sort_dicom_files(files):
     else:
         raise RuntimeError("Could not sort DICOM files base on Image Position (Patient)")
 
-def load_dicom_files(series_file_names, return_metadata=False, do_not_sort=False):
-    """Load a set of dicom files into a volume, loading metadata if desired."""
+def _writable_array_view(img):
+    """A writable numpy view of the pixel buffer of img.
+
+    SimpleITK only exposes read only views, so the view is rebuilt from the
+    buffer address. img must outlive the view, and must not be shared with
+    another image (ie freshly allocated) when the view is written to.
+    """
+    import ctypes
+    import numpy
+    view = sitk.GetArrayViewFromImage(img)
+    buf = (ctypes.c_char * view.nbytes).from_address(view.ctypes.data)
+    return numpy.frombuffer(buf, dtype=view.dtype).reshape(view.shape)
+
+def _read_image_information(file_name):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    return reader
+
+def series_geometry(series_file_names):
+    """Size, spacing, origin, direction, pixel id and components of a sorted series.
+
+    This is read from the first and last slice headers only, and matches what
+    ImageSeriesReader computes.
+    """
+    first = _read_image_information(series_file_names[0])
+    last = _read_image_information(series_file_names[-1])
+    return _geometry_from_headers(first, last, len(series_file_names))
+
+def _geometry_from_headers(first, last, count):
+    """series_geometry, from the header readers of the first and last of count slices."""
+    import numpy
+
+    size = list(first.GetSize())
+    size[2] = count
+    spacing = list(first.GetSpacing())
+    direction = list(first.GetDirection())
+    if count > 1:
+        step = numpy.subtract(last.GetOrigin(), first.GetOrigin())
+        distance = numpy.linalg.norm(step)
+        if distance > 0:
+            spacing[2] = distance / (count - 1)
+            direction[2::3] = step / distance
+
+    return dict(size=size, spacing=spacing, origin=first.GetOrigin(), direction=direction,
+                pixel_id=first.GetPixelID(), components=first.GetNumberOfComponents())
+
+def _empty_image(geometry, count=None):
+    size = list(geometry['size'])
+    if count is not None:
+        size[2] = count
+    img = sitk.Image(size, geometry['pixel_id'], geometry['components'])
+    img.SetOrigin(geometry['origin'])
+    img.SetSpacing(geometry['spacing'])
+    img.SetDirection(geometry['direction'])
+    return img
+
+def _decode_slices(file_names, array, pixel_id, threads=1):
+    """Decode each file into the matching slice of array, on threads threads."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def decode(ix):
+        img = sitk.ReadImage(file_names[ix], outputPixelType=pixel_id)
+        array[ix] = sitk.GetArrayViewFromImage(img)[0]
+
+    if threads == 1:
+        for ix in range(len(file_names)):
+            decode(ix)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # list() to surface any decoding exception
+        list(pool.map(decode, range(len(file_names))))
+
+def load_dicom_files_threaded(series_file_names, threads=None):
+    """Load sorted dicom files into a volume, decoding slices on a thread pool.
+
+    The volume is allocated once with the geometry of the series (as
+    ImageSeriesReader would compute it), and each thread decodes its slice
+    directly into the volume's pixel buffer. This pays off for compressed
+    transfer syntaxes (JPEG, JPEG2000, RLE), where decoding dominates.
+    """
+    if threads is None or threads < 1:
+        threads = os.cpu_count() or 1
+
+    geometry = series_geometry(series_file_names)
+    volume = _empty_image(geometry)
+    _decode_slices(series_file_names, _writable_array_view(volume), geometry['pixel_id'], threads)
+    return volume
+
+STREAMING_EXTENSIONS = (".nii", ".nii.gz", ".mha")
+
+def _streaming_header(geometry, ext):
+    """The header SimpleITK would write for the full series, as bytearray.
+
+    A single slice image with the series geometry is written to get the header,
+    and its slice count is then patched to the full count.
+    """
+    import numpy
+    import struct
+    import tempfile
+
+    template = _empty_image(geometry, count=1)
+    pixel_bytes = sitk.GetArrayViewFromImage(template).nbytes
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "header" + ext)
+        sitk.WriteImage(template, path, useCompression=False)
+        with open(path, "rb") as f:
+            data = f.read()
+    header = bytearray(data[:len(data)-pixel_bytes])
+
+    count = geometry['size'][2]
+    if ext == ".nii":
+        if struct.unpack_from("<i", header, 0)[0] != 348 or struct.unpack_from("<h", header, 40)[0] < 3:
+            raise RuntimeError("Unexpected NIfTI header layout from SimpleITK")
+        # dim[3], in the dim[8] array at byte 40
+        struct.pack_into("<h", header, 46, count)
+    else:
+        lines = header.decode("ascii").split("\n")
+        for ix, line in enumerate(lines):
+            if line.startswith("DimSize = "):
+                dims = line[len("DimSize = "):].split()
+                dims[2] = str(count)
+                lines[ix] = "DimSize = " + " ".join(dims)
+        header = bytearray("\n".join(lines).encode("ascii"))
+    return header
+
+def write_dicom_files_streaming(series_file_names, output_file, slab_size=64, threads=1, gzip_threads=0, gzip_level=6):
+    """Convert sorted dicom files to a NIfTI or MHA file, slab_size slices at a time.
+
+    Only one slab of slices is held in memory. The header is written from the
+    series geometry up front, then each slab is decoded (on threads threads)
+    and appended. .nii.gz outputs are compressed as they are written, with
+    gzip_threads threads (or single threaded, if 0). Multi-component series
+    can only be streamed to .mha.
+    """
+    import gzip
+    import numpy
+    from chi import pgzip
+
+    ext = next((e for e in STREAMING_EXTENSIONS if output_file.endswith(e)), None)
+    if ext is None:
+        raise ValueError(f"Streaming conversion only supports {STREAMING_EXTENSIONS}, not {output_file}")
+    if threads is None or threads < 1:
+        threads = os.cpu_count() or 1
+
+    geometry = series_geometry(series_file_names)
+    if ext != ".mha" and geometry['components'] > 1:
+        # NIfTI stores each component as a separate block, which can't be streamed by slice
+        raise ValueError(f"Streaming conversion of multi-component images only supports .mha, not {output_file}")
+    header = _streaming_header(geometry, ".mha" if ext == ".mha" else ".nii")
+    dtype = sitk.GetArrayViewFromImage(_empty_image(geometry, count=1)).dtype.newbyteorder("<")
+
+    # numpy order: slices, rows, columns (, components)
+    slice_shape = (geometry['size'][1], geometry['size'][0])
+    if geometry['components'] > 1:
+        slice_shape += (geometry['components'],)
+
+    # Written under a temporary name, so a slice that fails to decode leaves no
+    # truncated output behind
+    tmp = f"{output_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as raw:
+            if ext == ".nii.gz" and gzip_threads != 0:
+                out = pgzip.ParallelGzipWriter(raw, level=gzip_level, threads=gzip_threads)
+            elif ext == ".nii.gz":
+                out = gzip.GzipFile(filename=os.path.basename(output_file), fileobj=raw, mode="wb", compresslevel=gzip_level)
+            else:
+                out = contextlib.nullcontext(raw)
+            with out as out:
+                out.write(header)
+                slab = None
+                for start in range(0, len(series_file_names), slab_size):
+                    files = series_file_names[start:start+slab_size]
+                    if slab is None or slab.shape[0] != len(files):
+                        slab = numpy.empty((len(files),) + slice_shape, dtype=dtype)
+                    _decode_slices(files, slab, geometry['pixel_id'], threads)
+                    out.write(slab.tobytes())
+        os.replace(tmp, output_file)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+def load_dicom_files(series_file_names, return_metadata=False, do_not_sort=False, threads=0):
+    """Load a set of dicom files into a volume, loading metadata if desired.
+
+    With threads != 0 (and no metadata requested), slices are decoded in
+    parallel with load_dicom_files_threaded. threads=-1 uses all cores.
+    """
     if not isinstance(series_file_names, list):
         series_file_names = list(series_file_names)
 
     if not do_not_sort:
         series_file_names = sort_dicom_files(series_file_names)
 
+    if threads != 0 and not return_metadata:
+        return load_dicom_files_threaded(series_file_names, threads=threads)
+
     series_reader = sitk.ImageSeriesReader()
     series_reader.SetFileNames(series_file_names)
 
@@ -201,9 +408,9 @@ def list_files(d, glob_string=None):
 
     return (list(_list()))
 
-def scan_dir(dir, tags):
+def scan_dir(dir, tags, n_jobs=1):
     files = list_files(dir, "*.dcm")
-    return scan_files(files, tags)
+    return scan_files(files, tags, n_jobs=n_jobs)
 
 class SeriesLoadResult:
     """Interpret a set of files corresponding to a SeriesInstanceUID as volume(s).
@@ -230,21 +437,26 @@ class SeriesLoadResult:
         return cls(list(scan_result.index), get_subseries(scan_result), scan_result, series_id)
 
     @classmethod
-    def from_files(cls, files):
-        scan_result = scan_files(files, MULTI_VOLUME_TAGS)
+    def from_files(cls, files, n_jobs=1):
+        scan_result = scan_files(files, MULTI_VOLUME_TAGS, n_jobs=n_jobs)
         return cls.from_scan_result(scan_result)
 
     @classmethod
-    def from_dir(cls, dir):
-        scan_result = scan_dir(dir, MULTI_VOLUME_TAGS)
+    def from_dir(cls, dir, n_jobs=1):
+        scan_result = scan_dir(dir, MULTI_VOLUME_TAGS, n_jobs=n_jobs)
         return cls.from_scan_result(scan_result)
 
     def has_subseries(self):
         return bool(self.subseries)
     
-    def load_series(self):
+    def stream_series(self, output_file, slab_size=64, threads=1, gzip_threads=0, gzip_level=6):
         assert not self.has_subseries()
-        return load_dicom_files(self.files, return_metadata=False)
+        files = sort_dicom_files(list(self.files))
+        write_dicom_files_streaming(files, output_file, slab_size=slab_size, threads=threads, gzip_threads=gzip_threads, gzip_level=gzip_level)
+
+    def load_series(self, threads=0):
+        assert not self.has_subseries()
+        return load_dicom_files(self.files, return_metadata=False, threads=threads)
     
     def subseries_tags(self):
         return set(t for t in self.subseries)
@@ -261,6 +473,62 @@ class SeriesLoadResult:
         assert self.has_subseries()
         for val, files in self.subseries[tag].groups.items():
             yield val, load_dicom_files(files)
+
+    def load_all_subseries(self, tag, threads=1, images=False):
+        """Load every volume of the subseries tag in a single pass over the files.
+
+        Each file's header is read once, to sort the slices of each volume by
+        position along the slice normal (as IPPSorter does) and to get the volume
+        geometries, and its pixels are then decoded once (on threads threads, -1
+        for all cores) straight into the output.
+
+        Returns (volumes, metadata). volumes is a 4D array indexed (volume, z, y,
+        x), which needs all volumes to have the same size, or with images=True a
+        list of SimpleITK images. metadata has a row per volume, in the same order,
+        indexed by the subseries value: the scan table row of the volume's first
+        slice, its FileCount, and its Origin, Spacing and Direction.
+        """
+        import numpy
+
+        assert self.has_subseries()
+        if threads is None or threads < 1:
+            threads = os.cpu_count() or 1
+
+        values = []
+        volume_files = []
+        geometries = []
+        for val, files in self.subseries[tag].groups.items():
+            headers = {f: _read_image_information(f) for f in files}
+            normal = numpy.array(next(iter(headers.values())).GetDirection())[2::3]
+            files = sorted(files, key=lambda f: numpy.dot(headers[f].GetOrigin(), normal))
+            values.append(val)
+            volume_files.append(files)
+            geometries.append(_geometry_from_headers(headers[files[0]], headers[files[-1]], len(files)))
+
+        if images:
+            volumes = []
+            for files, geometry in zip(volume_files, geometries):
+                volume = _empty_image(geometry)
+                _decode_slices(files, _writable_array_view(volume), geometry['pixel_id'], threads)
+                volumes.append(volume)
+        else:
+            shapes = set((tuple(g['size']), g['pixel_id'], g['components']) for g in geometries)
+            if len(shapes) != 1:
+                raise ValueError(f"Subseries of {tag.tag_string()} have different sizes or pixel types, load them with images=True")
+            slice_view = sitk.GetArrayViewFromImage(_empty_image(geometries[0], count=1))
+            volumes = numpy.empty((len(values), len(volume_files[0])) + slice_view.shape[1:], dtype=slice_view.dtype)
+            flat = [f for files in volume_files for f in files]
+            _decode_slices(flat, volumes.reshape((-1,) + slice_view.shape[1:]), geometries[0]['pixel_id'], threads)
+
+        metadata = self.scan_result.loc[[files[0] for files in volume_files]]
+        metadata.index = pandas.Index(values, name=tag.tag_string())
+        metadata = metadata.assign(
+            FileCount=[len(files) for files in volume_files],
+            Origin=[tuple(g['origin']) for g in geometries],
+            Spacing=[tuple(g['spacing']) for g in geometries],
+            Direction=[tuple(g['direction']) for g in geometries],
+        )
+        return volumes, metadata
     
     def load_specific_subseries(self, tag, val):
         files = self.subseries[tag].groups[val]
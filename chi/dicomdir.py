@@ -0,0 +1,100 @@
+# Reading file indexes from DICOMDIR files.
+#
+# A DICOMDIR lists every instance of a media export as a tree of directory
+# records (PATIENT > STUDY > SERIES > IMAGE/...), with the instance's file path
+# (ReferencedFileID) relative to the DICOMDIR. So a file index, including series
+# level columns, can be built without opening any instance.
+
+import pydicom
+
+RECORD_COLUMNS = {
+    "PATIENT": ("PatientID", "PatientName"),
+    "STUDY": ("StudyInstanceUID", "StudyDate", "StudyDescription"),
+    "SERIES": ("SeriesInstanceUID", "Modality", "SeriesNumber"),
+}
+INSTANCE_COLUMNS = ("SOPInstanceUID", "InstanceNumber")
+
+COLUMNS = tuple(c for cols in RECORD_COLUMNS.values() for c in cols) + INSTANCE_COLUMNS
+
+def is_dicomdir_name(name):
+    return name.replace("\\", "/").rsplit("/", 1)[-1].upper() == "DICOMDIR"
+
+def _record_values(record, columns):
+    values = {}
+    for col in columns:
+        elem = record.data_element(col)
+        values[col] = None if elem is None or elem.is_empty else str(elem.value)
+    return values
+
+def _instance_row(record, context):
+    row = dict(context)
+    row.update(_record_values(record, INSTANCE_COLUMNS[1:]))
+    sop = record.get("ReferencedSOPInstanceUIDInFile")
+    row["SOPInstanceUID"] = None if sop is None else str(sop)
+    file_id = record.ReferencedFileID
+    if isinstance(file_id, str):
+        file_id = [file_id]
+    row["ReferencedFileID"] = "/".join(file_id)
+    return row
+
+def _walk_offsets(records, root_offset):
+    """Rows by following the record offsets, or None if they don't resolve."""
+    by_offset = {getattr(r, "seq_item_tell", None): r for r in records}
+    if root_offset not in by_offset:
+        return None
+
+    rows = []
+    seen = set()
+    def walk(offset, context):
+        while offset:
+            if offset in seen or offset not in by_offset:
+                raise ValueError(f"Bad directory record offset {offset}")
+            seen.add(offset)
+            record = by_offset[offset]
+            offset = record.get("OffsetOfTheNextDirectoryRecord", 0)
+            if record.get("RecordInUseFlag", 0xffff) == 0:
+                continue
+            rtype = str(record.DirectoryRecordType).strip()
+            sub_context = dict(context)
+            sub_context.update(_record_values(record, RECORD_COLUMNS.get(rtype, ())))
+            if "ReferencedFileID" in record:
+                rows.append(_instance_row(record, sub_context))
+            walk(record.get("OffsetOfReferencedLowerLevelDirectoryEntity", 0), sub_context)
+
+    try:
+        walk(root_offset, {})
+    except ValueError:
+        return None
+    return rows
+
+def _walk_sequential(records):
+    """Rows assuming records are listed depth first, for DICOMDIRs with bad offsets."""
+    rows = []
+    levels = list(RECORD_COLUMNS)
+    context = {}
+    for record in records:
+        if record.get("RecordInUseFlag", 0xffff) == 0:
+            continue
+        rtype = str(record.DirectoryRecordType).strip()
+        if rtype in RECORD_COLUMNS:
+            # Entering a new patient/study/series resets the lower levels
+            for level in levels[levels.index(rtype):]:
+                for col in RECORD_COLUMNS[level]:
+                    context.pop(col, None)
+            context.update(_record_values(record, RECORD_COLUMNS[rtype]))
+        if "ReferencedFileID" in record:
+            rows.append(_instance_row(record, context))
+    return rows
+
+def read_dicomdir(fp):
+    """One dict per instance listed in the DICOMDIR at fp (a path or file object).
+
+    Each dict has the COLUMNS inherited from its directory records, and the
+    instance's path relative to the DICOMDIR, '/' separated, in ReferencedFileID.
+    """
+    ds = pydicom.dcmread(fp, force=True)
+    records = ds.get("DirectoryRecordSequence", [])
+    rows = _walk_offsets(records, ds.get("OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity"))
+    if rows is None:
+        rows = _walk_sequential(records)
+    return rows
@@ -0,0 +1,88 @@
+# Walking a tree of files a directory at a time.
+#
+# Listing a tree of raw dicoms needs the relative path of every file, and a
+# DICOMDIR excludes every file under its directory. A DirListing holds the
+# result of a walk as a sorted table of distinct directories and a (directory
+# code, name) pair per file, so relative paths are computed once per directory
+# rather than per file, and the files under a directory are a contiguous range
+# of codes, found with a couple of binary searches. It only lives for the walk:
+# paths() gives the plain '/' separated paths the index tables hold.
+
+import bisect
+import fnmatch
+import os
+
+import numpy
+import pandas
+
+def _rel_dir(root, path):
+    rel = os.path.relpath(path, root)
+    return "" if rel == "." else rel.replace(os.sep, "/")
+
+class DirListing:
+    """The files of a walk, as codes into a sorted table of distinct directories."""
+    def __init__(self, dirs, dir_codes, names):
+        self.dirs = list(dirs)
+        self.dir_codes = numpy.asarray(dir_codes, dtype=numpy.int32)
+        self.names = pandas.Categorical(names)
+
+    @classmethod
+    def from_walk(cls, root, glob_string=None, prefix=""):
+        """Files under root, relative to root and prefixed by the posix path prefix.
+
+        Directory paths are computed once per directory, not per file.
+        """
+        prefix = "" if prefix in ("", ".") else prefix.strip("/")
+        dirs = []
+        dir_codes = []
+        names = []
+        for r, _, files in os.walk(root):
+            if glob_string is not None:
+                files = fnmatch.filter(files, glob_string)
+            if not files:
+                continue
+            rel = _rel_dir(root, r)
+            dirs.append(f"{prefix}/{rel}" if prefix and rel else prefix or rel)
+            dir_codes.extend([len(dirs) - 1] * len(files))
+            names.extend(files)
+        # Re-code so the directory table is sorted
+        order = sorted(range(len(dirs)), key=dirs.__getitem__)
+        recode = numpy.empty(len(dirs), dtype=numpy.int32)
+        recode[order] = numpy.arange(len(dirs), dtype=numpy.int32)
+        return cls([dirs[i] for i in order], recode[numpy.asarray(dir_codes, dtype=numpy.int64)], names)
+
+    def __len__(self):
+        return len(self.dir_codes)
+
+    def _dir_prefixes(self, root=None):
+        if root is None:
+            prefixes = [f"{d}/" if d else "" for d in self.dirs]
+        else:
+            prefixes = [os.path.join(root, d, "") for d in self.dirs]
+        return numpy.array(prefixes, dtype=object)
+
+    def paths(self, root=None):
+        """The paths, as an object array; joined onto root with os.path if given."""
+        names = numpy.asarray(self.names, dtype=object)
+        return self._dir_prefixes(root)[self.dir_codes] + names
+
+    def dir_range(self, prefix):
+        """Code of the directory prefix (or None), and codes [lo, hi) of those under it."""
+        prefix = prefix.strip("/")
+        if not prefix:
+            return None, 0, len(self.dirs)
+        exact = bisect.bisect_left(self.dirs, prefix)
+        if exact == len(self.dirs) or self.dirs[exact] != prefix:
+            exact = None
+        # '0' sorts right after '/'
+        return exact, bisect.bisect_left(self.dirs, prefix + "/"), bisect.bisect_left(self.dirs, prefix + "0")
+
+    def under(self, *prefixes):
+        """Boolean mask of the files in or under any of the directory prefixes."""
+        mask = numpy.zeros(len(self), dtype=bool)
+        for prefix in prefixes:
+            exact, lo, hi = self.dir_range(prefix)
+            mask |= (self.dir_codes >= lo) & (self.dir_codes < hi)
+            if exact is not None:
+                mask |= self.dir_codes == exact
+        return mask
@@ -0,0 +1,129 @@
+# Memory mapped access to raw dicom files and zip archive members.
+#
+# An archive is mapped once, and stored members are handed out as memoryview
+# slices of the mapping, located by parsing the member's local file header.
+# BufferReader wraps such a slice as a read-only file object, so a parser only
+# copies the bytes it actually reads (eg not the pixel data, when reading headers
+# with stop_before_pixels). Compressed members fall back to zipfile's streaming
+# inflate.
+
+import contextlib
+import io
+import mmap
+import os
+import struct
+import zipfile
+
+class BufferReader(io.RawIOBase):
+    """A seekable, read-only file object over a buffer, without copying it."""
+    def __init__(self, buf, name=None):
+        self._buf = memoryview(buf).cast("B")
+        self._pos = 0
+        if name is not None:
+            self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._buf) + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if pos < 0:
+            raise ValueError("Negative seek position")
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        end = len(self._buf) if size is None or size < 0 else min(self._pos + size, len(self._buf))
+        data = self._buf[self._pos:end].tobytes() if end > self._pos else b""
+        self._pos = max(self._pos, end)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def getbuffer(self):
+        return self._buf
+
+    def close(self):
+        self._buf.release()
+        super().close()
+
+def _map(fp):
+    # mmap refuses empty files
+    if os.fstat(fp.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _unmap(mapped):
+    if isinstance(mapped, mmap.mmap):
+        mapped.close()
+
+@contextlib.contextmanager
+def map_file(path):
+    """Map the file at path, yielding a memoryview of its contents."""
+    with open(path, "rb") as fp:
+        mapped = _map(fp)
+        view = memoryview(mapped)
+        try:
+            yield view
+        finally:
+            view.release()
+            _unmap(mapped)
+
+class MappedZip:
+    """A zip archive mapped once, giving zero copy access to stored members."""
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        self._map = _map(self._fp)
+        self._view = memoryview(self._map)
+        self.zf = zipfile.ZipFile(self._fp, "r")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+        self._view.release()
+        _unmap(self._map)
+        self._fp.close()
+
+    def getinfo(self, name):
+        return self.zf.getinfo(name)
+
+    def member_view(self, name):
+        """memoryview of a stored member, or None if it is compressed."""
+        info = self.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        header = self._view[info.header_offset:info.header_offset+30]
+        if header[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile(f"No local file header for {name} in {self.path}")
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        start = info.header_offset + 30 + name_len + extra_len
+        return self._view[start:start+info.file_size]
+
+    def open(self, name):
+        """A file object for a member; zero copy if the member is stored."""
+        view = self.member_view(name)
+        if view is None:
+            return self.zf.open(name)
+        return BufferReader(view, name=name)
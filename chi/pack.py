@@ -0,0 +1,88 @@
+# Series packs: a single uncompressed zip or tar archive holding the files of
+# one series, with an index of the byte range of every member.
+#
+# Since members are stored, a member is read back with one seek and one read on
+# the pack file, without going through zipfile/tarfile at all. The index has
+# the same layout as the zip_archive_index output (FileName index, ArcName), with
+# the archive in the Pack column and the member's data in [Offset, Offset+Size).
+
+import io
+import shutil
+import struct
+import tarfile
+import time
+import zipfile
+
+import pandas
+
+PACK_FORMATS = ("zip", "tar")
+INDEX_SUFFIX = ".index.csv"
+
+def pack_path(name, fmt):
+    return f"{name}.{fmt}"
+
+def index_path(pack_file):
+    return pack_file + INDEX_SUFFIX
+
+def _zip_data_offset(fp, header_offset):
+    # Local file header: 30 fixed bytes, then the name and extra field
+    fp.seek(header_offset)
+    header = fp.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise ValueError(f"No local file header at offset {header_offset}")
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return header_offset + 30 + name_len + extra_len
+
+def zip_member_ranges(path):
+    """{name: (offset, size)} for the stored members of a zip file."""
+    ranges = {}
+    with zipfile.ZipFile(path, "r") as zf, open(path, "rb") as fp:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Member {info.filename} of {path} is compressed")
+            ranges[info.filename] = (_zip_data_offset(fp, info.header_offset), info.file_size)
+    return ranges
+
+def tar_member_ranges(path):
+    """{name: (offset, size)} for the regular files in an uncompressed tar file."""
+    with tarfile.open(path, "r:") as tf:
+        return {m.name: (m.offset_data, m.size) for m in tf.getmembers() if m.isfile()}
+
+def write_pack(path, members, fmt):
+    """Write (name, size, file object) members to a stored pack at path."""
+    if fmt == "zip":
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zf:
+            for name, size, fp in members:
+                with zf.open(name, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as of:
+                    shutil.copyfileobj(fp, of)
+        return zip_member_ranges(path)
+    elif fmt == "tar":
+        with tarfile.open(path, "w:", format=tarfile.PAX_FORMAT) as tf:
+            for name, size, fp in members:
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = int(time.time())
+                tf.addfile(info, fp)
+        return tar_member_ranges(path)
+    else:
+        raise ValueError(f"Unknown pack format {fmt}")
+
+def make_pack_index(rel_pack, rel_dir, ranges):
+    names = sorted(ranges)
+    index = pandas.Index([f"{rel_dir}/{n}" for n in names], name="FileName")
+    return pandas.DataFrame({
+        "Pack": [rel_pack]*len(names),
+        "ArcName": names,
+        "Offset": [ranges[n][0] for n in names],
+        "Size": [ranges[n][1] for n in names],
+    }, index=index)
+
+def is_pack_index(tab):
+    return {'Pack', 'Offset', 'Size'}.issubset(tab.columns)
+
+def read_member(fp, offset, size):
+    fp.seek(int(offset))
+    data = fp.read(int(size))
+    if len(data) != int(size):
+        raise IOError(f"Short read at offset {offset} of {getattr(fp, 'name', fp)}")
+    return io.BytesIO(data)
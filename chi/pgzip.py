@@ -0,0 +1,123 @@
+# Parallel gzip compression, in the style of pigz.
+#
+# The input is cut into fixed size blocks which are deflated independently on a
+# thread pool (zlib releases the GIL while compressing). Each block is primed with
+# the last 32 KiB of the previous block as a dictionary, so the ratio is close to
+# single threaded gzip. Every block but the last ends with a sync flush, which
+# byte-aligns the output, so the blocks can simply be concatenated into a single
+# deflate stream. The result is a standard single member gzip file.
+
+import collections
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+_WINDOW_SIZE = 1 << 15
+
+def _deflate_block(block, zdict, level, last):
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(block) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _gzip_header(level, mtime=None):
+    if mtime is None:
+        mtime = int(time.time())
+    if level == 9:
+        xfl = 2
+    elif level == 1:
+        xfl = 4
+    else:
+        xfl = 0
+    # No flags, unknown OS
+    return b"\x1f\x8b\x08\x00" + struct.pack("<IBB", mtime & 0xffffffff, xfl, 255)
+
+class ParallelGzipWriter:
+    """A write-only binary file object, gzipping into dst on a thread pool.
+
+    Data is cut into block_size blocks as it is written, and at most a couple of
+    blocks per thread are held in memory. close() finishes the gzip stream, but
+    does not close dst. A with block left by an exception abandons the stream.
+    """
+    def __init__(self, dst, level=6, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+        if threads is None or threads < 1:
+            threads = os.cpu_count() or 1
+        self.dst = dst
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.closed = False
+        self._crc = 0
+        self._size = 0
+        self._zdict = b""
+        self._buf = bytearray()
+        self._pending = collections.deque()
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self.dst.write(_gzip_header(level))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            # The stream won't be finished, so don't compress what is left
+            self.closed = True
+            self._pool.shutdown(cancel_futures=True)
+
+    def _submit(self, block, last):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._pool.submit(_deflate_block, block, self._zdict, self.level, last))
+        self._zdict = block[-_WINDOW_SIZE:]
+        # Bound memory use to a couple of blocks per thread
+        while len(self._pending) > 2 * self.threads:
+            self.dst.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buf += data
+        # Keep the last full block back, since only close() knows which block is last
+        pos = 0
+        while len(self._buf) - pos > self.block_size:
+            self._submit(bytes(self._buf[pos:pos+self.block_size]), False)
+            pos += self.block_size
+        del self._buf[:pos]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self._buf), True)
+            self._buf = bytearray()
+            while self._pending:
+                self.dst.write(self._pending.popleft().result())
+            self.dst.write(struct.pack("<II", self._crc, self._size & 0xffffffff))
+        finally:
+            self._pool.shutdown()
+
+def compress_stream(src, dst, level=6, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Gzip the binary file object src into the binary file object dst."""
+    with ParallelGzipWriter(dst, level=level, threads=threads, block_size=block_size) as writer:
+        while True:
+            block = src.read(block_size)
+            if not block:
+                break
+            writer.write(block)
+
+def compress_file(src_path, dst_path, level=6, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Gzip src_path to dst_path, which is only replaced once compression succeeds."""
+    tmp = f"{dst_path}.{os.getpid()}.tmp"
+    try:
+        with open(src_path, "rb") as src, open(tmp, "wb") as dst:
+            compress_stream(src, dst, level=level, threads=threads, block_size=block_size)
+        os.replace(tmp, dst_path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
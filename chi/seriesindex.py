@@ -0,0 +1,134 @@
+# Scan tables partitioned by series.
+#
+# convert and filter tasks only need the rows of the few series they convert,
+# but reading a csv scan table means parsing all of it. A partitioned index holds
+# the same table with its rows grouped into buckets by a hash of their
+# SeriesInstanceUID. Each bucket is a csv block with its own header, and a footer
+# at the end of the file gives the byte range of each bucket, so looking up a set
+# of series reads the footer and the buckets they hash to, and nothing else.
+#
+# Layout: bucket blocks, a JSON footer, then a fixed size trailer holding the
+# footer's offset and a magic string.
+
+import io
+import json
+import os
+import struct
+import zlib
+
+import numpy
+import pandas
+
+MAGIC = b"CHISERIESINDEX1\n"
+_TRAILER = struct.Struct("<Q16s")
+DEFAULT_BUCKETS = 256
+
+def bucket_of(key, buckets):
+    # Not hash(), which is salted per process
+    return zlib.crc32(str(key).encode("utf-8")) % buckets
+
+_TRUE_VALUES = frozenset(("True", "TRUE", "true"))
+_FALSE_VALUES = frozenset(("False", "FALSE", "false"))
+
+def _inferred_dtype(values):
+    from pandas._libs.parsers import STR_NA_VALUES
+    values = pandas.Series(values, dtype=str)
+    present = values.loc[~values.isin(STR_NA_VALUES)]
+    has_na = len(present) < len(values)
+    if len(present) == 0:
+        return numpy.dtype("float64")
+    try:
+        numbers = pandas.to_numeric(present)
+    except (TypeError, ValueError):
+        pass
+    else:
+        # Integer columns with missing values are read as float
+        return numpy.dtype("float64") if has_na and numbers.dtype.kind in "iu" else numbers.dtype
+    if present.isin(_TRUE_VALUES | _FALSE_VALUES).all():
+        return numpy.dtype(object) if has_na else numpy.dtype(bool)
+    return values.dtype
+
+def inferred_dtypes(table):
+    """{column: dtype} (the index included) that pandas.read_csv would infer for
+    a table of strings read with dtype=str and keep_default_na=False."""
+    dtypes = {table.index.name: _inferred_dtype(table.index)}
+    dtypes.update((name, _inferred_dtype(table[name])) for name in table.columns)
+    return dtypes
+
+def write_partitioned(table, path, buckets=DEFAULT_BUCKETS, key="SeriesInstanceUID", dtypes=None):
+    """Write table to path, partitioned into buckets by its key column.
+
+    dtypes ({column: dtype}, the index included) are stored for reading back.
+    """
+    codes = table[key].map(lambda k: bucket_of(k, buckets))
+    parts = {}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fp:
+        for bucket, part in table.groupby(codes, sort=True):
+            start = fp.tell()
+            fp.write(part.to_csv().encode("utf-8"))
+            parts[str(bucket)] = [start, fp.tell() - start, part.shape[0]]
+        footer_offset = fp.tell()
+        header = table.iloc[:0].to_csv()
+        footer = dict(key=key, buckets=buckets, header=header, rows=table.shape[0], parts=parts,
+                      dtypes={k: str(v) for k, v in (dtypes or {}).items()})
+        fp.write(json.dumps(footer).encode("utf-8"))
+        fp.write(_TRAILER.pack(footer_offset, MAGIC))
+    os.replace(tmp, path)
+    return footer
+
+def _read_trailer(fp):
+    fp.seek(0, io.SEEK_END)
+    if fp.tell() < _TRAILER.size:
+        return None
+    fp.seek(-_TRAILER.size, io.SEEK_END)
+    footer_offset, magic = _TRAILER.unpack(fp.read(_TRAILER.size))
+    return footer_offset if magic == MAGIC else None
+
+def is_partitioned(path):
+    with open(path, "rb") as fp:
+        return _read_trailer(fp) is not None
+
+class PartitionedIndex:
+    """A partitioned scan table, read a few series at a time."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            footer_offset = _read_trailer(fp)
+            if footer_offset is None:
+                raise ValueError(f"{path} is not a partitioned index")
+            fp.seek(footer_offset)
+            footer = json.loads(fp.read()[:-_TRAILER.size])
+        self.key = footer['key']
+        self.buckets = footer['buckets']
+        self.header = footer['header']
+        self.rows = footer['rows']
+        self.parts = {int(b): tuple(r) for b, r in footer['parts'].items()}
+        self.dtypes = footer.get('dtypes', {})
+
+    def __len__(self):
+        return self.rows
+
+    def read(self, keys, **kwargs):
+        """Rows whose key is in keys; kwargs are passed to pandas.read_csv.
+
+        Columns get the dtypes stored by write_partitioned, unless kwargs give
+        a dtype, rather than types inferred from the few buckets read.
+        """
+        keys = set(str(k) for k in keys)
+        buckets = sorted(set(bucket_of(k, self.buckets) for k in keys) & set(self.parts))
+        data = io.BytesIO()
+        data.write(self.header.encode("utf-8"))
+        header_size = data.tell()
+        with open(self.path, "rb") as fp:
+            for bucket in buckets:
+                start, size, _ = self.parts[bucket]
+                fp.seek(start)
+                # Every block starts with the same header
+                fp.seek(header_size, io.SEEK_CUR)
+                data.write(fp.read(size - header_size))
+        data.seek(0)
+        if self.dtypes:
+            kwargs.setdefault("dtype", self.dtypes)
+        table = pandas.read_csv(data, **kwargs)
+        return table.loc[table[self.key].astype(str).isin(keys)]
@@ -1,8 +1,42 @@
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
+import collections
 import pandas
+import os
 import time
 import argparse
 
+class _BatchSizer:
+    """Sizes task batches to take about target seconds each, from the measured cost per item.
+
+    A size of "auto" starts at one item per task, and adapts as results come in;
+    an int is a fixed size.
+    """
+    MAX_SIZE = 1000
+
+    def __init__(self, size="auto", target=0.2, max_size=MAX_SIZE):
+        self.auto = size == "auto"
+        self.size = 1 if self.auto else max(int(size), 1)
+        self.target = target
+        self.max_size = max(max_size, 1)
+        self.cost = None
+
+    def update(self, count, seconds):
+        if not self.auto or count == 0:
+            return
+        cost = seconds / count
+        self.cost = cost if self.cost is None else (self.cost + cost) / 2
+        self.size = int(min(max(self.target / max(self.cost, 1e-9), 1), self.max_size))
+
+    def batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
 class BatchParRun:
     def iterate(self, start=0, stop=None):
         raise NotImplementedError()
@@ -29,14 +63,52 @@ class BatchParRun:
             execute_args = tuple()
         return iter_args, execute_args
 
-    def run_parallel(self, n_jobs=-1, start=0, stop=None, iter_args=None, execute_args=None):
+    def execute_batch(self, batch, execute_args, combine=False):
+        """Execute each arg of batch, returning its non-None results, the count,
+        the time taken and the metrics recorded in task_metrics.
+
+        With combine, the results are concatenated, so a single table is sent back.
+        """
+        tic = Tic()
+        # Counts added to by execute_one, summed over the run into metrics
+        self.task_metrics = collections.Counter()
+        results = [r for r in (self.execute_one(arg, *execute_args) for arg in batch) if r is not None]
+        if combine and len(results) > 1:
+            results = [pandas.concat(results, axis=0)]
+        return results, len(batch), tic.toc(), self.task_metrics
+
+    def _run_batched(self, n_jobs, start, stop, iter_args, execute_args, batch_size, combine, **parallel_args):
         iter_args, execute_args = self._prep_args(iter_args, execute_args)
-        
-        results = Parallel(n_jobs=n_jobs, verbose=10)(delayed(self.execute_one)(arg, *execute_args) for arg in self.iterate(start, stop, *iter_args))
-        results = filter(lambda r: r is not None, results)
-        results = pandas.concat(results, axis=0)
+        max_size = _BatchSizer.MAX_SIZE
+        if stop is not None:
+            # Leave a few batches per worker, to balance the load
+            max_size = min(max_size, (stop - start) // (4 * effective_n_jobs(n_jobs)))
+        sizer = _BatchSizer(batch_size, max_size=max_size)
+
+        batches = sizer.batches(self.iterate(start, stop, *iter_args))
+        tasks = (delayed(self.execute_batch)(batch, execute_args, combine) for batch in batches)
+        # Tasks are batches already, so joblib mustn't batch them again
+        self.metrics = collections.Counter()
+        for results, count, seconds, metrics in Parallel(n_jobs=n_jobs, batch_size=1, **parallel_args)(tasks):
+            sizer.update(count, seconds)
+            self.metrics.update(metrics)
+            yield from results
+
+    def run_parallel(self, n_jobs=-1, start=0, stop=None, iter_args=None, execute_args=None, batch_size=1):
+        """Execute every item, concatenating the results.
+
+        Items are sent to the workers batch_size at a time, or with "auto", in
+        batches sized to amortize the dispatch overhead of items that are quick.
+        """
+        results = self._run_batched(n_jobs, start, stop, iter_args, execute_args, batch_size, True, verbose=10, return_as="generator")
+        results = pandas.concat(list(results), axis=0)
         return results
 
+    def iter_parallel(self, n_jobs=-1, start=0, stop=None, iter_args=None, execute_args=None, ordered=True, batch_size=1):
+        """Like run_parallel, but yield each non-None result as it completes."""
+        return_as = "generator" if ordered else "generator_unordered"
+        yield from self._run_batched(n_jobs, start, stop, iter_args, execute_args, batch_size, False, return_as=return_as)
+
     def run_from_args(self, args, iter_args=None, execute_args=None):
         iter_args, execute_args = self._prep_args(iter_args, execute_args)
         start = args.batch_start
@@ -44,13 +116,17 @@ class BatchParRun:
         if args.batch_count > -1:
             stop = min(start + args.batch_count, stop)
 
-        return self.run_parallel(n_jobs=args.jobs, start=start, stop=stop, iter_args=iter_args, execute_args=execute_args)
+        return self.run_parallel(n_jobs=args.jobs, start=start, stop=stop, iter_args=iter_args, execute_args=execute_args, batch_size=args.task_batch)
 
     @classmethod
     def update_parser(cls, parser):
         parser.add_argument("--batch_start", default=0, type=int)
         parser.add_argument("--batch_count", default=-1, type=int)
         parser.add_argument("--jobs", default=-1, type=int)
+        parser.add_argument("--task_batch", default="auto", type=_task_batch_size, help="Items per parallel task, or auto to size batches from the measured time per item.")
+
+def _task_batch_size(value):
+    return value if value == "auto" else int(value)
 
 
 class DFBatchParRun(BatchParRun):
@@ -100,6 +176,30 @@ class FunctionDFBatchParRun(DFBatchParRun):
     
 
 
+_table_cache = None
+
+def enable_table_cache():
+    """Keep tables read with read_table in memory, for long running processes."""
+    global _table_cache
+    _table_cache = {}
+
+def read_table(path, **kwargs):
+    """pandas.read_csv, served from memory if the table cache is enabled.
+
+    Cached tables are shared between callers, so must not be modified in place.
+    A table is re-read when its file's size or modification time changes.
+    """
+    if _table_cache is None:
+        return pandas.read_csv(path, **kwargs)
+
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    key = (os.path.abspath(path), repr(sorted(kwargs.items())))
+    cached = _table_cache.get(key)
+    if cached is None or cached[0] != stamp:
+        _table_cache[key] = (stamp, pandas.read_csv(path, **kwargs))
+    return _table_cache[key][1]
+
 class Tic:
     def __init__(self):
         self.tic()
@@ -165,12 +265,15 @@ class EntryPoints:
         return f
     
 
-    def parse_args(self):
+    def names(self):
+        return [ep.name for ep in self.entrypoints]
+
+    def parse_args(self, argv=None):
         parser, subparsers = make_parser(self.common_parser)
         for ep in self.entrypoints:
             ep.prepare_parser(parser, subparsers)
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
         return args
 
     def main(self):